@@ -0,0 +1,128 @@
+import asyncio
+import os
+from queue import Queue
+from threading import Thread
+from urllib.parse import urlsplit
+
+from logzero import logger as log
+
+from .app import get_source, settings
+from .utils import (
+    calculate_crc32,
+    calculate_multipart_etags,
+    crc_in_log,
+    get_epg_log_url,
+    get_etag_part_sizes,
+    save_epg_log,
+)
+
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None
+
+
+# Optional engine for the many small, latency-bound requests of the batch
+# commands: they run concurrently on one event loop while hashing stays on
+# worker threads. boto3 has no asyncio API, S3 API calls keep using threads.
+
+_warned = False
+
+
+def is_enabled():
+    global _warned
+    if not settings.ASYNC_ENGINE:
+        return False
+    if aiohttp is None:
+        if not _warned:
+            log.warning("ASYNC_ENGINE needs aiohttp (pip install epg_downloader[async]), using threads")
+            _warned = True
+        return False
+    return True
+
+
+class Engine(object):
+    # One HTTP session, at most per_host requests in flight to every host
+    def __init__(self, per_host=None):
+        self.per_host = per_host or settings.ASYNC_PER_HOST
+        self.limits = {}
+        self.session = None
+
+    async def __aenter__(self):
+        # The semaphores do the limiting, not the connection pool
+        self.session = aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=0))
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.session.close()
+
+    def limit(self, url):
+        host = urlsplit(url).netloc
+        if host not in self.limits:
+            self.limits[host] = asyncio.Semaphore(self.per_host)
+        return self.limits[host]
+
+    async def request(self, method, url, auth=None):
+        # Returns (headers, body), raises on error statuses
+        async with self.limit(url):
+            async with self.session.request(method, url, auth=auth) as r:
+                body = await r.read()
+                r.raise_for_status()
+                return r.headers, body
+
+    async def epg_request(self, method, url, source=None):
+        source = source or get_source()
+        return await self.request(method, url, aiohttp.BasicAuth(source.user, source.password))
+
+
+async def run_in(pool, func, *args):
+    # Like utils.run_in, without blocking the event loop. Without a pool
+    # func runs on the loop's default executor, for DB and small file work
+    return await asyncio.get_running_loop().run_in_executor(pool, func, *args)
+
+
+async def check_crc(engine, filename, entry_id, hash_pool=None, source=None):
+    _, body = await engine.epg_request("GET", get_epg_log_url(entry_id, source), source)
+    content = body.decode("utf-8", "replace")
+    await run_in(None, save_epg_log, filename, content)
+    crc32 = await run_in(hash_pool, calculate_crc32, filename)
+    return crc_in_log(crc32, content)
+
+
+async def check_etag(engine, filename, url, hash_pool=None, part_size=None):
+    headers, _ = await engine.request("HEAD", url)
+    uploaded, size = headers["ETag"], int(headers["Content-Length"])
+    part_sizes = get_etag_part_sizes(uploaded, size, part_size)
+    log.info(f"Uploaded etag {uploaded} for {filename}, part sizes {part_sizes}")
+    if not part_sizes or os.path.getsize(filename) != size:
+        return False
+    return uploaded in await run_in(hash_pool, calculate_multipart_etags, filename, part_sizes)
+
+
+def iter_completed(make_coros, per_host=None):
+    # Runs the coroutines make_coros(engine) returns on an event loop in its
+    # own thread, and yields their results as they complete. The first
+    # exception is raised here.
+    results = Queue()
+    done = object()
+
+    async def main():
+        async with Engine(per_host) as engine:
+            for future in asyncio.as_completed(list(make_coros(engine))):
+                results.put((await future, None))
+
+    def run():
+        try:
+            asyncio.run(main())
+        except Exception as e:
+            results.put((None, e))
+        results.put((done, None))
+
+    Thread(target=run, name="aio", daemon=True).start()
+    while True:
+        result, error = results.get()
+        if error is not None:
+            raise error
+        if result is done:
+            return
+        yield result
@@ -1,4 +1,13 @@
+from contextlib import contextmanager
+from datetime import datetime
+import os
+import pickle
+import socket
+from threading import Condition, Event, Thread, local
+
 from environs import Env
+from logzero import logger as log
+from peewee import Expression
 from playhouse.kv import KeyValue
 from playhouse.sqlite_ext import SqliteExtDatabase
 
@@ -8,9 +17,14 @@ env.read_env(".env")
 
 
 class settings:
-    EPG_USER = env('EPG_USER')
-    EPG_PASSWORD = env('EPG_PASSWORD')
-    EPG_HOST = env('EPG_HOST')
+    # JSON list of {"name", "host", "user", "password", "protocol",
+    # "key_prefix", "s3_prefix", "workers"}, one per EPGStation. key_prefix
+    # defaults to the name, except for the first source: it defaults to
+    # KEY_PREFIX so it keeps the entries saved before EPG_SOURCES was set.
+    EPG_SOURCES = env.json('EPG_SOURCES', default=None)
+    EPG_USER = env('EPG_USER', default=None) if EPG_SOURCES else env('EPG_USER')
+    EPG_PASSWORD = env('EPG_PASSWORD', default=None) if EPG_SOURCES else env('EPG_PASSWORD')
+    EPG_HOST = env('EPG_HOST', default=None) if EPG_SOURCES else env('EPG_HOST')
     EPG_PROTOCOL = env('EPG_PROTOCOL', default='http')
     AWS_REGION_NAME = env('AWS_REGION_NAME')
     AWS_ACCESS_KEY_ID = env('AWS_ACCESS_KEY_ID')
@@ -19,6 +33,16 @@ class settings:
     AWS_S3_PREFIX = env('AWS_S3_PREFIX', default='')
     DIRECTORY = env('DIRECTORY', default=env('PWD'))
     DATABASE_PATH = env('DATABASE_PATH', default=f'{DIRECTORY}/epg_downloader.db')
+    # NORMAL only risks the last transactions on power loss in WAL mode
+    SQLITE_SYNCHRONOUS = env('SQLITE_SYNCHRONOUS', default='normal')
+    SQLITE_CACHE_SIZE = env.int('SQLITE_CACHE_SIZE', default=64 * 1024)  # KiB
+    SQLITE_MMAP_SIZE = env.int('SQLITE_MMAP_SIZE', default=256 * 1024 * 1024)
+    SQLITE_TEMP_STORE = env('SQLITE_TEMP_STORE', default='memory')
+    SQLITE_BUSY_TIMEOUT = env.float('SQLITE_BUSY_TIMEOUT', default=30)  # seconds
+    # The WAL is truncated back to this size after a checkpoint
+    SQLITE_JOURNAL_SIZE_LIMIT = env.int('SQLITE_JOURNAL_SIZE_LIMIT', default=64 * 1024 * 1024)
+    # Checkpoint interval while jobs are running, 0 to leave it to SQLite
+    SQLITE_CHECKPOINT_SECONDS = env.int('SQLITE_CHECKPOINT_SECONDS', default=300)
     AWS_S3_ENDPOINT_URL = env(
         'AWS_S3_ENDPOINT_URL',
         'https://{}.digitaloceanspaces.com'.format(AWS_REGION_NAME),
@@ -28,15 +52,385 @@ class settings:
         'https://{}.{}.cdn.digitaloceanspaces.com'.format(AWS_STORAGE_BUCKET_NAME, AWS_REGION_NAME),
     )
     KEY_PREFIX = 'epgd'
+    # Smallest part size, doubled up to S3_MAX_PART_SIZE until a recording
+    # fits in S3_TARGET_PARTS parts
+    S3_PART_SIZE = env.int('S3_PART_SIZE', default=8 * 1024 * 1024)
+    S3_MAX_PART_SIZE = env.int('S3_MAX_PART_SIZE', default=256 * 1024 * 1024)
+    S3_TARGET_PARTS = env.int('S3_TARGET_PARTS', default=500)
+    # Parts read ahead of the upload workers are kept in memory
+    S3_UPLOAD_MEMORY = env.int('S3_UPLOAD_MEMORY', default=1024 * 1024 * 1024)
+    S3_UPLOAD_WORKERS = env.int('S3_UPLOAD_WORKERS', default=8)
+    # Set to crc32 to have S3 verify CRC32 checksums per part & full object
+    S3_CHECKSUM = env('S3_CHECKSUM', default='')
+    S3_GZIP_SIDECARS = env.bool('S3_GZIP_SIDECARS', default=False)
+    # JSON list of {"name", "bucket", "endpoint_url", "region_name", "prefix",
+    # "access_key_id", "secret_access_key", "workers"}. Each one gets a copy
+    # of every video upload, missing keys default to the primary's settings.
+    # name defaults to the endpoint & bucket and must be unique.
+    S3_MIRRORS = env.json('S3_MIRRORS', default=None)
+    # Parts a mirror may be behind the primary on top of its workers, they're
+    # kept in memory. It's dropped once it's that far behind and made no
+    # progress for S3_MIRROR_TIMEOUT seconds.
+    S3_MIRROR_MAX_BEHIND = env.int('S3_MIRROR_MAX_BEHIND', default=16)
+    S3_MIRROR_TIMEOUT = env.float('S3_MIRROR_TIMEOUT', default=120)
+    JOB_MAX_ATTEMPTS = env.int('JOB_MAX_ATTEMPTS', default=8)
+    JOB_BACKOFF_SECONDS = env.int('JOB_BACKOFF_SECONDS', default=300)
+    JOB_BACKOFF_MAX_SECONDS = env.int('JOB_BACKOFF_MAX_SECONDS', default=24 * 60 * 60)
+    JOB_LEASE_SECONDS = env.int('JOB_LEASE_SECONDS', default=600)
+    WORKER_ID = env('WORKER_ID', default=f'{socket.gethostname()}:{os.getpid()}')
+    # Falls back to unicode61 if SQLite doesn't have it (trigram needs 3.34)
+    FTS_TOKENIZE = env('FTS_TOKENIZE', default='trigram')
+    MEDIAINFO_WORKERS = env.int('MEDIAINFO_WORKERS', default=2)
+    MEDIAINFO_PARSE_SPEED = env.float('MEDIAINFO_PARSE_SPEED', default=0.5)
+    # Only analyze the head of the stream, 0 to let MediaInfo read what it needs
+    MEDIAINFO_MAX_BYTES = env.int('MEDIAINFO_MAX_BYTES', default=0)
+    DOWNLOAD_BUFFER_SIZE = env.int('DOWNLOAD_BUFFER_SIZE', default=8 * 1024 * 1024)
+    # never, end (once the download finishes) or always (after every buffer)
+    DOWNLOAD_FSYNC = env('DOWNLOAD_FSYNC', default='end')
+    # Drops downloaded recordings from the page cache once they're fsynced
+    DOWNLOAD_FADVISE = env.bool('DOWNLOAD_FADVISE', default=True)
+    # Bytes of uploaded recordings kept in DIRECTORY, 0 deletes them right away
+    LOCAL_CACHE_SIZE = env.int('LOCAL_CACHE_SIZE', default=0)
+    # Download & upload recordings while they're still being recorded. Each
+    # one holds a worker of its source until the recording ends.
+    TAIL_RECORDINGS = env.bool('TAIL_RECORDINGS', default=False)
+    TAIL_POLL_SECONDS = env.int('TAIL_POLL_SECONDS', default=30)
+    # The final size isn't known yet, 64 MiB allows up to 640 GB
+    TAIL_PART_SIZE = env.int('TAIL_PART_SIZE', default=64 * 1024 * 1024)
+    EPG_WORKERS = env.int('EPG_WORKERS', default=4)
+    # Migrate entries on an older schema in the background while epg-to-s3 runs
+    BACKGROUND_MIGRATION = env.bool('BACKGROUND_MIGRATION', default=False)
+    # Bytes per second shared by all transfers, 0 for unlimited
+    BANDWIDTH_LIMIT = env.int('BANDWIDTH_LIMIT', default=0)
+    CHECK_WORKERS = env.int('CHECK_WORKERS', default=8)
+    HASH_WORKERS = env.int('HASH_WORKERS', default=os.cpu_count() or 1)
+    # Run the small requests of batch commands on an event loop (needs aiohttp),
+    # with at most ASYNC_PER_HOST of them in flight to each host
+    ASYNC_ENGINE = env.bool('ASYNC_ENGINE', default=False)
+    ASYNC_PER_HOST = env.int('ASYNC_PER_HOST', default=64)
+
+
+class EPGSource(object):
+    def __init__(self, name, host, user=None, password=None, protocol="http",
+                 key_prefix=None, s3_prefix=None, workers=1):
+        self.name = name
+        self.host = host
+        self.user = user
+        self.password = password
+        self.protocol = protocol
+        self.key_prefix = key_prefix or name
+        self.s3_prefix = settings.AWS_S3_PREFIX if s3_prefix is None else s3_prefix
+        self.workers = workers
+
+    @property
+    def base_url(self):
+        return "{}://{}".format(self.protocol, self.host)
+
+    def __repr__(self):
+        return f"<EPGSource {self.name}: {self.base_url}>"
+
+
+def load_sources():
+    if not settings.EPG_SOURCES:
+        return [
+            EPGSource(
+                "default",
+                settings.EPG_HOST,
+                settings.EPG_USER,
+                settings.EPG_PASSWORD,
+                settings.EPG_PROTOCOL,
+                key_prefix=settings.KEY_PREFIX,
+            )
+        ]
+    first, *others = settings.EPG_SOURCES
+    return [EPGSource(**dict({"key_prefix": settings.KEY_PREFIX}, **first))] + [
+        EPGSource(**source) for source in others
+    ]
+
+
+sources = load_sources()
+
+
+def get_source(name=None):
+    # The first source is the default, and is used for entries saved before
+    # sources were introduced
+    if name is None:
+        return sources[0]
+    for source in sources:
+        if source.name == name:
+            return source
+    raise KeyError(f"Unknown EPGStation source {name}")
+
+
+def get_entry_source(entry):
+    return get_source(entry.get("source"))
 
 
 database = SqliteExtDatabase(
     settings.DATABASE_PATH,
     pragmas=(
-        ('cache_size', -1024 * 4),  # 4MB page-cache.
+        ('cache_size', -settings.SQLITE_CACHE_SIZE),  # Negative is in KiB.
         ('journal_mode', 'wal'),  # Use WAL-mode (you should always use this!).
-        ('foreign_keys', 1)  # Enforce foreign-key constraints.
-    )
+        ('foreign_keys', 1),  # Enforce foreign-key constraints.
+        ('synchronous', settings.SQLITE_SYNCHRONOUS),
+        ('mmap_size', settings.SQLITE_MMAP_SIZE),
+        ('temp_store', settings.SQLITE_TEMP_STORE),
+        ('journal_size_limit', settings.SQLITE_JOURNAL_SIZE_LIMIT),
+    ),
+    timeout=settings.SQLITE_BUSY_TIMEOUT,
 )
 
-kv_store = KeyValue(database=database)
+
+def checkpoint_database(mode="passive"):
+    # Returns (busy, frames in the WAL, frames checkpointed)
+    return database.execute_sql(f"PRAGMA wal_checkpoint({mode.upper()})").fetchone()
+
+
+def optimize_database(analyze=False):
+    if analyze:
+        database.execute_sql("ANALYZE")
+    database.execute_sql("PRAGMA optimize")
+
+
+def close_database():
+    kv_store.flush()
+    if not database.is_closed():
+        optimize_database()
+        database.close()
+
+
+@contextmanager
+def checkpointing(interval=None):
+    # Writers keep the WAL busy, so SQLite's automatic checkpoints can fall
+    # behind. Checkpoint from a separate connection while the block runs.
+    interval = settings.SQLITE_CHECKPOINT_SECONDS if interval is None else interval
+    if not interval:
+        yield
+        return
+    stopped = Event()
+
+    def run():
+        with database.connection_context():
+            while not stopped.wait(interval):
+                checkpoint_database()
+
+    thread = Thread(target=run, daemon=True)
+    thread.start()
+    try:
+        yield
+    finally:
+        stopped.set()
+        thread.join()
+        checkpoint_database("truncate")
+
+
+def get_database_stats():
+    page_size = database.page_size
+    page_count = database.pragma("page_count")
+    freelist_count = database.pragma("freelist_count")
+    wal_path = f"{settings.DATABASE_PATH}-wal"
+    return {
+        "path": settings.DATABASE_PATH,
+        "page_size": page_size,
+        "page_count": page_count,
+        "freelist_count": freelist_count,
+        "db_size": page_size * page_count,
+        "free_size": page_size * freelist_count,
+        "wal_size": os.path.getsize(wal_path) if os.path.exists(wal_path) else 0,
+        "journal_mode": database.journal_mode,
+        "synchronous": database.pragma("synchronous"),
+        "cache_size": database.cache_size,
+        "mmap_size": database.mmap_size,
+    }
+
+
+def get_raw_key(db_key):
+    return f"raw_{db_key}"
+
+
+def get_upload_key(db_key):
+    # Open multipart uploads of an entry, saved while it's uploading
+    return f"upload_{db_key}"
+
+
+NOTHING = object()
+
+
+class EntryStore(KeyValue):
+    # Entries keep the EPGStation payload under a separate key so listing
+    # entries doesn't unpickle it.
+    #
+    # Every write goes through a single writer thread. Entries only send the
+    # fields that changed, which are merged into the stored entry, so threads
+    # updating different fields of the same entry don't lose each other's
+    # updates. Reads use the calling thread's own connection and see writes
+    # that are still queued. flush() waits until they are committed.
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._cond = Condition()
+        # key -> [whole value or NOTHING, {field: value}]
+        self._pending = {}
+        self._writing = {}
+        # Every save_many call gets the next number, the writer commits them
+        # in order
+        self._queued = 0
+        self._committed = 0
+        # (after, upto, error) for the saves after+1..upto that failed
+        self._failed = []
+        # Numbers of the saves each thread made since its last flush()
+        self._saves = local()
+        self._writer = None
+        # Called with every batch of {key: value}, in the same transaction
+        self.write_hooks = []
+
+    def __setitem__(self, expr, value):
+        if isinstance(expr, Expression):
+            self.flush()
+            return super().__setitem__(expr, value)
+        self.save_many({expr: value})
+
+    def save_many(self, mapping, touch=True):
+        # Everything saved in one call is committed in the same transaction.
+        # Entries get updated_on stamped unless touch is off (imports).
+        changes = []
+        now = datetime.now().isoformat() if touch else None
+        for key, value in mapping.items():
+            if touch and hasattr(value, "pop_changes") and value.has_changes():
+                value["updated_on"] = now
+            raw = value.pop_unsaved_raw() if hasattr(value, "pop_unsaved_raw") else None
+            if raw is not None:
+                changes.append((get_raw_key(key), raw, None))
+            fields = value.pop_changes() if hasattr(value, "pop_changes") else None
+            if fields is None:
+                # Snapshot, the caller may keep changing the value
+                changes.append((key, pickle.loads(pickle.dumps(value)), None))
+            elif fields:
+                changes.append((key, NOTHING, fields))
+        if not changes:
+            return
+        with self._cond:
+            for key, value, fields in changes:
+                if fields is None:
+                    # Field updates other threads queued still apply on top
+                    queued = {}
+                    for change in (self._writing.get(key), self._pending.get(key)):
+                        if change is not None:
+                            queued.update(change[1])
+                    self._pending[key] = [value, queued]
+                else:
+                    self._pending.setdefault(key, [NOTHING, {}])[1].update(fields)
+            self._queued += 1
+            self._get_saves().append(self._queued)
+            if self._writer is None or not self._writer.is_alive():
+                self._writer = Thread(target=self._run, name="kv-writer", daemon=True)
+                self._writer.start()
+            self._cond.notify_all()
+
+    def flush(self):
+        # Barrier, returns once everything saved before the call is committed.
+        # Raises the error of the first save of this thread that failed.
+        with self._cond:
+            target = self._queued
+            while self._committed < target:
+                self._cond.wait()
+            saves = self._get_saves()
+            error = next((e for save in saves for after, upto, e in self._failed if after < save <= upto), None)
+            saves.clear()
+        if error is not None:
+            raise error
+
+    def _get_saves(self):
+        saves = getattr(self._saves, "saves", None)
+        if saves is None:
+            saves = self._saves.saves = []
+        elif len(saves) > 1000:
+            # A thread that never flushes only has to keep the failed ones
+            saves[:] = [
+                save for save in saves
+                if save > self._committed or any(after < save <= upto for after, upto, _ in self._failed)
+            ]
+        return saves
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._pending:
+                    self._cond.wait()
+                self._writing, self._pending = self._pending, {}
+                target = self._queued
+            error = None
+            try:
+                with self._database.connection_context():
+                    self._write(self._writing)
+            except Exception as e:
+                log.error(f"Failed saving {len(self._writing)} keys", exc_info=True)
+                error = e
+            with self._cond:
+                if error is not None:
+                    self._failed.append((self._committed, target, error))
+                self._writing = {}
+                self._committed = target
+                self._cond.notify_all()
+
+    def _write(self, batch):
+        rows = {}
+        # Take the write lock first. Upgrading a read transaction fails right
+        # away, without waiting, if another connection wrote in the meantime.
+        with self._database.atomic(lock_type="IMMEDIATE"):
+            for key, (value, fields) in batch.items():
+                if fields:
+                    if value is NOTHING:
+                        try:
+                            value = super().__getitem__(key)
+                        except KeyError:
+                            log.warning(f"Dropping update of {key}, it was never saved")
+                            continue
+                    for name, field_value in fields.items():
+                        value[name] = field_value
+                rows[key] = value
+            if rows:
+                # Stay under SQLite's limit of variables per statement
+                items = list(rows.items())
+                for i in range(0, len(items), 1000):
+                    self.update(dict(items[i:i + 1000]))
+                for hook in self.write_hooks:
+                    hook(rows)
+
+    def _get_queued(self, key):
+        with self._cond:
+            return [
+                (change[0], dict(change[1]))
+                for change in (self._writing.get(key), self._pending.get(key))
+                if change is not None
+            ]
+
+    def __getitem__(self, expr):
+        # Expressions only read the DB, flush() first if that matters
+        converted, is_single = self.convert_expression(expr)
+        changes = self._get_queued(expr) if is_single else None
+        if not changes:
+            return super().__getitem__(expr)
+        value, fields = NOTHING, {}
+        for whole, changed in changes:
+            if whole is not NOTHING:
+                value, fields = whole, {}
+            fields.update(changed)
+        # Copy, the queued value is shared with the thread that saved it
+        value = super().__getitem__(expr) if value is NOTHING else pickle.loads(pickle.dumps(value))
+        for name, field_value in fields.items():
+            value[name] = field_value
+        if hasattr(value, "pop_changes"):
+            value.pop_changes()
+        return value
+
+    def __contains__(self, key):
+        if not isinstance(key, Expression) and self._get_queued(key):
+            return True
+        return super().__contains__(key)
+
+    def __delitem__(self, expr):
+        self.flush()
+        super().__delitem__(expr)
+
+
+kv_store = EntryStore(database=database)
@@ -1,6 +1,7 @@
 # -*- coding: utf-8 -*-
 
 """Console script for epg_downloader."""
+import json
 from pathlib import Path
 from pprint import pformat
 import sys
@@ -8,29 +9,49 @@ import sys
 import click
 from tabulate import tabulate
 
-from .app import settings
+from .app import (
+    checkpoint_database,
+    close_database,
+    get_database_stats,
+    optimize_database,
+    settings,
+)
 from .clients import S3
+from .models import EntryStats, Job, LocalFile
+from .utils import format_rows, open_ndjson
 from .epg_downloader import (
-    check_dl,
-    check_ul,
+    bulk_delete,
+    check_all,
+    cleanup_multipart,
     delete_from_epg,
-    delete_from_s3,
     delete_local,
     download_all_from_epg,
     download_one_from_epg,
+    enqueue_failed_entries,
+    export_entries,
+    evict_local,
     epg_to_s3_all,
     gen_html,
+    get_crc_all,
     get_db_entry,
     get_entries_to_download,
     get_entries_to_upload,
+    get_entries_with_failed_sidecars,
     get_entry,
     get_free_space,
     get_info,
+    get_stats,
+    import_entries,
     list_entries,
     migrate_data,
+    reconcile_s3,
+    rebuild_stats,
+    reindex_entries,
+    search_entries,
     update_from_epg,
     upload_all_to_s3,
     upload_one,
+    upload_sidecars,
     upload_to_s3,
 )
 
@@ -61,6 +82,7 @@ pass_epg_config = click.make_pass_decorator(EPGConfig, ensure=True)
 @pass_epg_config
 def main(epg_config, directory, **kwargs):
     epg_config.set_values(**kwargs)
+    click.get_current_context().call_on_close(close_database)
     return 0
 
 
@@ -103,16 +125,41 @@ def auto_old(epg_config, **kwargs):
     is_flag=True,
     help="Check upload to AWS S3 / DO Spaces",
 )
-def check(entry_ids, dl, ul):
+@click.option(
+    "--all", "-a", "all_entries", default=False, is_flag=True, help="Check all local entries"
+)
+@click.option("--status", help="Check local entries with the given status")
+@click.option(
+    "--jobs", "-j", type=int, default=settings.CHECK_WORKERS, help="Concurrent checks"
+)
+@click.option(
+    "--hash-jobs", type=int, default=settings.HASH_WORKERS, help="Concurrent file hashing"
+)
+@click.option(
+    "--bad-file", "-o", type=click.Path(dir_okay=False), help="Write IDs that failed to this file"
+)
+def check(entry_ids, dl, ul, all_entries, status, jobs, hash_jobs, bad_file):
+    """Verify downloads/uploads of the given (or selected) entries"""
     if not dl and not ul:
         dl = True
-    for entry_id in entry_ids:
-        if dl:
-            msg = "Good" if check_dl(entry_id) else "Bad"
-            click.echo(f"{entry_id} dl: {msg}")
-        if ul:
-            msg = "Good" if check_ul(entry_id) else "Bad"
-            click.echo(f"{entry_id} ul: {msg}")
+    if all_entries and not status:
+        status = "all"
+    counts = {"Good": 0, "Bad": 0}
+    bad_ids = set()
+    bad_fp = open(bad_file, "w") if bad_file else None
+    try:
+        for entry_id, kind, is_valid in check_all(entry_ids, dl, ul, jobs, hash_jobs, status):
+            msg = "Good" if is_valid else "Bad"
+            counts[msg] += 1
+            click.echo(f"{entry_id} {kind}: {msg}")
+            if not is_valid and bad_fp and entry_id not in bad_ids:
+                bad_ids.add(entry_id)
+                bad_fp.write(f"{entry_id}\n")
+                bad_fp.flush()
+    finally:
+        if bad_fp:
+            bad_fp.close()
+    click.echo(f"Good: {counts['Good']}, Bad: {counts['Bad']}")
 
 
 @click.command()
@@ -208,12 +255,56 @@ def init(database):
     default=True,
     help="Show/Hide status",
 )
-def ls(status, fields, show_status):
+@click.option(
+    "--format",
+    "-F",
+    "fmt",
+    type=click.Choice(["table", "ndjson", "csv", "tsv"]),
+    default="table",
+    help="Output format",
+)
+@click.option("--limit", "-n", type=int, help="Show at most this many entries")
+@click.option(
+    "--sort", help="Sort by the given field (prefix with - to reverse), default is by key"
+)
+@click.option(
+    "--since", type=click.DateTime(), help="Only show recordings started on/after this date"
+)
+def ls(status, fields, show_status, fmt, limit, sort, since):
     """List all downloads/uploads"""
-    click.echo(tabulate(list_entries(status, fields, show_status), headers="keys"))
+    rows = list_entries(status, fields, show_status, limit=limit, sort=sort, since=since)
+    for line in format_rows(rows, fmt):
+        click.echo(line)
     return 0
 
 
+@click.command()
+@click.argument("term", required=False)
+@click.option("--limit", "-n", type=int, default=20, help="Show at most this many matches")
+@click.option(
+    "--raw", default=False, is_flag=True, help="Use FTS5 query syntax (AND, OR, NEAR, prefix*)"
+)
+@click.option("--reindex", default=False, is_flag=True, help="Rebuild the search index")
+@click.option(
+    "--format",
+    "-F",
+    "fmt",
+    type=click.Choice(["table", "ndjson", "csv", "tsv"]),
+    default="table",
+    help="Output format",
+)
+def search(term, limit, raw, reindex, fmt):
+    """Search names, descriptions & channels of recordings
+
+    With the default trigram tokenizer terms need at least 3 characters.
+    """
+    if reindex:
+        click.echo(f"Indexed {reindex_entries()} entries")
+    if term:
+        for line in format_rows(search_entries(term, limit, raw), fmt):
+            click.echo(line)
+
+
 @click.command()
 def generate_html():
     gen_html()
@@ -223,13 +314,15 @@ def generate_html():
 @click.argument("entry_ids", nargs=-1)
 def info(entry_ids):
     for entry_id in entry_ids:
-        click.echo(pformat(get_info(entry_id)))
+        click.echo(pformat(get_info(entry_id).to_dict()))
 
 
 @click.command()
-def migrate():
+@click.option("--batch-size", default=1000, show_default=True, help="Entries saved per transaction")
+def migrate(batch_size):
     click.echo("Migrating data")
-    migrate_data()
+    for scanned, migrated in migrate_data(batch_size):
+        click.echo(f"Scanned {scanned}, migrated {migrated}")
     click.echo("Done")
 
 
@@ -258,7 +351,9 @@ def migrate():
     is_flag=True,
     help="Delete on AWS S3 / DO Spaces",
 )
-def delete(entry_ids, force, epg, s3):
+@click.option("--jobs", "-j", type=int, default=settings.EPG_WORKERS, help="Concurrent EPGStation deletes")
+def delete(entry_ids, force, epg, s3, jobs):
+    to_delete = {"local": [], "epg": [], "s3": []}
     for entry_id in entry_ids:
         entry = get_db_entry(entry_id)
         filename = entry["filename"]
@@ -268,7 +363,7 @@ def delete(entry_ids, force, epg, s3):
             confirm = click.confirm(f"Do you really want to delete {filename} locally?")
         if confirm:
             click.echo(f"Deleting {filename}")
-            delete_local(entry=entry)
+            to_delete["local"].append(entry)
         if epg and (force or entry["epg_status"] == "downloaded"):
             if force:
                 confirm = True
@@ -278,8 +373,8 @@ def delete(entry_ids, force, epg, s3):
                 )
             if confirm:
                 click.echo(f"Deleting {entry['id']} {filename} from EPGStation")
-                delete_from_epg(entry=entry, force=force)
-        if s3 and (force or entry["s3_status"] == "uploaded"):
+                to_delete["epg"].append(entry)
+        if s3 and (force or entry.get("s3_status") == "uploaded"):
             if force:
                 confirm = True
             else:
@@ -288,7 +383,170 @@ def delete(entry_ids, force, epg, s3):
                 )
             if confirm:
                 click.echo(f"Deleting {entry['id']} {filename} from S3 / Spaces")
-                delete_from_s3(entry=entry)
+                to_delete["s3"].append(entry)
+    failed = bulk_delete(force=force, jobs=jobs, **to_delete)
+    for storage, ids in failed.items():
+        for entry_id in ids:
+            click.echo(f"Failed deleting {entry_id} from {storage}")
+
+
+@click.command()
+@click.option(
+    "--s3", "--spaces", "-s", default=False, is_flag=True, help="Reconcile against AWS S3 / DO Spaces"
+)
+@click.option(
+    "--show-orphans", default=False, is_flag=True, help="List objects without a matching entry"
+)
+def reconcile(s3, show_orphans):
+    """Update statuses from a listing of the storage"""
+    if not s3:
+        click.echo("Nothing to reconcile, use --s3")
+        return 1
+    result = reconcile_s3()
+    counts = ", ".join(f"{status}: {count}" for status, count in result["counts"].items())
+    click.echo(f"{counts}, changed: {result['changed']}, orphans: {len(result['orphans'])}")
+    if show_orphans:
+        for key in result["orphans"]:
+            click.echo(key)
+
+
+@click.command()
+@click.option(
+    "--status", "-s", default="all", help="Filter jobs based on status (all, pending, failed, done)"
+)
+@click.option(
+    "--requeue", "-r", multiple=True, help="Retry the given entry from the start now"
+)
+@click.option(
+    "--add-failed", default=False, is_flag=True, help="Queue entries with download/upload errors"
+)
+def queue(status, requeue, add_failed):
+    """Show/Manage the work queue"""
+    for entry_id in requeue:
+        Job.enqueue(get_db_entry(entry_id)["db_key"], reset=True)
+    if add_failed:
+        click.echo(f"Queued {enqueue_failed_entries()} entries")
+    jobs = Job.select(
+        Job.db_key,
+        Job.stage,
+        Job.status,
+        Job.attempts,
+        Job.next_run_on,
+        Job.worker_id,
+        Job.lease_expires_on,
+        Job.last_error,
+    ).order_by(Job.next_run_on)
+    if status != "all":
+        jobs = jobs.where(Job.status == status)
+    click.echo(tabulate(jobs.dicts(), headers="keys"))
+
+
+@click.command()
+@click.option(
+    "--evict", default=False, is_flag=True, help="Delete files until the cache fits LOCAL_CACHE_SIZE"
+)
+def local_cache(evict):
+    """Show recordings kept locally after upload, least recently used first"""
+    if evict:
+        evict_local()
+    files = LocalFile.select(
+        LocalFile.db_key, LocalFile.filename, LocalFile.size, LocalFile.accessed_on,
+    ).order_by(LocalFile.accessed_on)
+    click.echo(tabulate(files.dicts(), headers="keys"))
+    click.echo(f"Total: {LocalFile.total_size()} / {settings.LOCAL_CACHE_SIZE} bytes")
+
+
+@click.command()
+@click.option(
+    "--checkpoint",
+    type=click.Choice(["passive", "full", "restart", "truncate"]),
+    help="Checkpoint the WAL into the database",
+)
+@click.option("--analyze", default=False, is_flag=True, help="Refresh all query planner statistics")
+@click.option("--optimize", default=False, is_flag=True, help="Run PRAGMA optimize")
+def db_maintenance(checkpoint, analyze, optimize):
+    """Show database/WAL sizes and run maintenance"""
+    if checkpoint:
+        busy, wal_frames, checkpointed = checkpoint_database(checkpoint)
+        click.echo(f"Checkpointed {checkpointed}/{wal_frames} WAL frames{' (busy)' if busy else ''}")
+    if analyze or optimize:
+        optimize_database(analyze)
+    for key, value in get_database_stats().items():
+        click.echo(f"{key}: {value}")
+
+
+@click.command()
+@click.option(
+    "--group-by",
+    "-g",
+    multiple=True,
+    type=click.Choice(list(EntryStats.GROUPS)),
+    help="Group totals, can be given more than once",
+)
+@click.option(
+    "--format",
+    "-F",
+    "fmt",
+    default="table",
+    type=click.Choice(["table", "json", "ndjson", "csv", "tsv"]),
+    help="Output format",
+)
+@click.option("--rebuild", default=False, is_flag=True, help="Recompute the stats table from all entries")
+def stats(group_by, fmt, rebuild):
+    """Show entry counts, sizes in bytes and transfer rates in bytes/s"""
+    if rebuild:
+        click.echo(f"Rebuilt stats of {rebuild_stats()} entries", err=True)
+    rows = get_stats(group_by)
+    if fmt == "json":
+        click.echo(json.dumps(rows, indent=True, ensure_ascii=False))
+        return
+    for line in format_rows(rows, fmt):
+        click.echo(line)
+
+
+@click.command()
+@click.argument("path", default="-")
+@click.option(
+    "--compression",
+    type=click.Choice(["none", "gzip", "zstd"]),
+    help="Defaults to the extension of PATH (.gz, .zst)",
+)
+@click.option("--since", type=click.DateTime(), help="Only entries updated since then")
+def export_cmd(path, compression, since):
+    """Write all entries as NDJSON to PATH, or stdout"""
+    with open_ndjson(path, "w", compression) as stream:
+        count = export_entries(stream, since and since.isoformat())
+    click.echo(f"Exported {count} entries", err=True)
+
+
+@click.command()
+@click.argument("path", default="-")
+@click.option(
+    "--compression",
+    type=click.Choice(["none", "gzip", "zstd"]),
+    help="Defaults to the extension of PATH (.gz, .zst)",
+)
+@click.option("--since", type=click.DateTime(), help="Only entries updated since then")
+@click.option("--batch-size", default=5000, show_default=True, help="Entries saved per transaction")
+def import_cmd(path, compression, since, batch_size):
+    """Add or replace the entries of an NDJSON export from PATH, or stdin"""
+    with open_ndjson(path, "r", compression) as stream:
+        count = import_entries(stream, since and since.isoformat(), batch_size)
+    click.echo(f"Imported {count} entries", err=True)
+
+
+@click.command()
+@click.option(
+    "--older-than", default=24.0, show_default=True, help="Hours since the upload was started and its resume state was saved",
+)
+@click.option("--dry-run", "-n", default=False, is_flag=True, help="Only list the uploads")
+def cleanup_multipart_cmd(older_than, dry_run):
+    """Abort multipart uploads that no entry can resume"""
+    count = 0
+    for name, key, upload_id in cleanup_multipart(older_than * 3600, dry_run):
+        click.echo(f"{'Would abort' if dry_run else 'Aborted'} {name}: {key} {upload_id}")
+        count += 1
+    click.echo(f"{count} stale uploads", err=True)
 
 
 @click.command()
@@ -342,36 +600,40 @@ def upload_json():
 
 @click.command()
 @click.argument("entry_ids", nargs=-1)
-def get_crc(entry_ids):
-    import os
-    import zlib
-    from .utils import calculate_multipart_etag
+@click.option(
+    "--failed", default=False, is_flag=True, help="Retry all sidecars that failed to upload"
+)
+def upload_sidecars_cmd(entry_ids, failed):
+    """Upload the .json, .log & .mediainfo.json files of entries"""
+    for entry_id in entry_ids:
+        entry = get_entry(entry_id)
+        upload_sidecars(entry)
+        click.echo(f"{entry['id']}: {entry['sidecar_status']}")
+    if failed:
+        for entry, names in list(get_entries_with_failed_sidecars()):
+            upload_sidecars(entry, names)
+            click.echo(f"{entry['id']}: {entry['sidecar_status']}")
 
-    s3 = S3()
+
+@click.command()
+@click.argument("entry_ids", nargs=-1)
+@click.option(
+    "--jobs", "-j", type=int, default=settings.CHECK_WORKERS, help="Concurrent downloads"
+)
+def get_crc(entry_ids, jobs):
+    """Generate the .log of uploaded entries by streaming them from S3"""
+    entries = []
     for entry_id in entry_ids:
         entry = get_info(entry_id)
-        filename = entry["filename"]
-        log_file = f"{filename}.log"
-        if Path(log_file).is_file():
+        if Path(f"{entry['filename']}.log").is_file():
             click.echo(f"Skip {entry_id}: log exists")
             continue
-        click.echo(f"Downloading {entry_id}")
-        resp = s3.download(filename)
-        click.echo(f"Check etag for {entry_id}")
-        etag = calculate_multipart_etag(filename)
-        if etag not in resp["ETag"]:
-            click.echo(f"Error downloading {entry_id}")
-            continue
-        click.echo(f"Generate CRC for {entry_id}")
-        with open(filename, "rb") as fp:
-            crc32 = zlib.crc32(fp.read())
-        crc_str = hex(crc32)[2:]
-        with open(log_file, "w") as fp:
-            fp.write(f"crc32: {crc_str}")
-        s3.upload(log_file, {"ContentType": "text/plain; charset=utf-8"})
-        # Delete file
-        click.echo(f"Deleting {filename}")
-        os.unlink(filename)
+        entries.append(entry)
+    for entry, result in get_crc_all(entries, jobs):
+        if isinstance(result, Exception):
+            click.echo(f"Error {entry['id']}: {result}")
+        else:
+            click.echo(f"{entry['id']} crc32: {result}")
 
     click.echo("Done")
 
@@ -385,23 +647,33 @@ def auto_all(entry_ids):
 main.add_command(get_crc, name="get-crc")
 main.add_command(auto_all, name="auto")
 main.add_command(check)
+main.add_command(cleanup_multipart_cmd, name="cleanup-multipart")
+main.add_command(db_maintenance, name="db-maintenance")
 main.add_command(delete)
 main.add_command(delete, name="del")
 main.add_command(delete, name="rm")
 main.add_command(download)
 main.add_command(download, name="dl")
 main.add_command(download_all)
+main.add_command(export_cmd, name="export")
 main.add_command(generate_html, name="generate")
 main.add_command(pending)
 main.add_command(pipeline)
+main.add_command(import_cmd, name="import")
 main.add_command(info)
 main.add_command(ls)
 main.add_command(ls, name="list")
+main.add_command(local_cache, name="local-cache")
 main.add_command(migrate)
+main.add_command(queue)
+main.add_command(reconcile)
+main.add_command(search)
 main.add_command(upload)
 main.add_command(upload_all)
 main.add_command(upload_json)
 main.add_command(upload_json, name="upload-json")
+main.add_command(upload_sidecars_cmd, name="upload-sidecars")
+main.add_command(stats)
 main.add_command(show_free)
 main.add_command(show_free, name="free")
 
@@ -1,24 +1,51 @@
+import base64
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+import hashlib
+import os
+from threading import Lock, Thread
+import time
+import zlib
+
 import boto3
+from botocore.exceptions import ClientError
+from logzero import logger as log
 
 from .app import settings
+from .utils import bandwidth, encode_crc32, get_multipart_etag, get_part_size
 
 
 class S3(object):
     bucket = settings.AWS_STORAGE_BUCKET_NAME
     endpoint = settings.AWS_S3_ENDPOINT_URL
 
-    def __init__(self):
+    def __init__(self, prefix=None, name="primary", bucket=None, endpoint_url=None,
+                 region_name=None, access_key_id=None, secret_access_key=None, workers=None):
+        self.prefix = settings.AWS_S3_PREFIX if prefix is None else prefix
+        self.name = name
+        self.bucket = bucket or self.bucket
+        self.endpoint = endpoint_url or self.endpoint
+        self.region_name = region_name or settings.AWS_REGION_NAME
+        self.access_key_id = access_key_id or settings.AWS_ACCESS_KEY_ID
+        self.secret_access_key = secret_access_key or settings.AWS_SECRET_ACCESS_KEY
+        self.workers = workers or settings.S3_UPLOAD_WORKERS
         self.session = boto3.session.Session()
+        self._client = None
+        self._lock = Lock()
 
     @property
     def client(self):
-        return self.session.client(
-            "s3",
-            region_name=settings.AWS_REGION_NAME,
-            endpoint_url=self.endpoint,
-            aws_access_key_id=settings.AWS_ACCESS_KEY_ID,
-            aws_secret_access_key=settings.AWS_SECRET_ACCESS_KEY,
-        )
+        # Clients are thread-safe but creating them from one session is not,
+        # so create it once and share it between threads.
+        with self._lock:
+            if self._client is None:
+                self._client = self.session.client(
+                    "s3",
+                    region_name=self.region_name,
+                    endpoint_url=self.endpoint,
+                    aws_access_key_id=self.access_key_id,
+                    aws_secret_access_key=self.secret_access_key,
+                )
+        return self._client
 
     def download(self, filename):
         remote_name = self.get_key(filename)
@@ -28,8 +55,8 @@ class S3(object):
         return self.client.head_object(Bucket=self.bucket, Key=remote_name)
 
     def get_key(self, filename):
-        if settings.AWS_S3_PREFIX:
-            return f"{settings.AWS_S3_PREFIX}/{filename}"
+        if self.prefix:
+            return f"{self.prefix}/{filename}"
         else:
             return filename
 
@@ -43,12 +70,394 @@ class S3(object):
         )
         return remote_name
 
-    def upload_content(self, filename, content):
-        remote_name = self.get_key(filename)
-        self.client.upload_fileobj(
-            content, self.bucket, remote_name, ExtraArgs={"ACL": "public-read"},
+    def upload_multipart(self, filename, extra_args=None, part_size=None, workers=None, checksum=None):
+        # Returns the ETag S3 reported along with the ETag & CRC32 we expect
+        if workers:
+            self.workers = workers
+        result = upload_multipart_to([self], filename, extra_args, part_size, checksum)[self.name]
+        if isinstance(result, Exception):
+            raise result
+        return result
+
+    def _put_single(self, remote_name, data, md5, crc32, extra_args, checksum):
+        # A 1 part multipart upload gets a "-1" ETag, use a plain PUT instead
+        kwargs = {"ContentMD5": base64.b64encode(md5.digest()).decode()}
+        if checksum:
+            kwargs["ChecksumCRC32"] = encode_crc32(crc32)
+        resp = self.client.put_object(
+            Body=data, Bucket=self.bucket, Key=remote_name, **extra_args, **kwargs,
+        )
+        return {
+            "key": remote_name,
+            "etag": resp["ETag"],
+            "expected_etag": get_multipart_etag([md5]),
+            "crc32": crc32,
+            "part_size": len(data),
+        }
+
+    def _upload_part(self, remote_name, upload_id, part_number, data, md5, checksum):
+        kwargs = {"ContentMD5": base64.b64encode(md5.digest()).decode()}
+        if checksum:
+            kwargs["ChecksumCRC32"] = encode_crc32(zlib.crc32(data))
+        resp = self.client.upload_part(
+            Bucket=self.bucket,
+            Key=remote_name,
+            UploadId=upload_id,
+            PartNumber=part_number,
+            Body=data,
+            **kwargs,
         )
+        if resp["ETag"].strip('"') != md5.hexdigest():
+            raise ValueError(f"{remote_name}: E-Tag of part {part_number} does not match.")
+        part = {"PartNumber": part_number, "ETag": resp["ETag"]}
+        if checksum:
+            part["ChecksumCRC32"] = resp["ChecksumCRC32"]
+        return part
+
+    def list_parts(self, remote_name, upload_id):
+        parts = {}
+        paginator = self.client.get_paginator("list_parts")
+        for page in paginator.paginate(Bucket=self.bucket, Key=remote_name, UploadId=upload_id):
+            for part in page.get("Parts", []):
+                parts[part["PartNumber"]] = part
+        return parts
+
+    def list_multipart_uploads(self, prefix=None):
+        if prefix is None:
+            prefix = self.prefix
+        paginator = self.client.get_paginator("list_multipart_uploads")
+        for page in paginator.paginate(Bucket=self.bucket, Prefix=prefix or ""):
+            for upload in page.get("Uploads", []):
+                yield upload
+
+    def abort_multipart(self, remote_name, upload_id):
+        self.client.abort_multipart_upload(Bucket=self.bucket, Key=remote_name, UploadId=upload_id)
+
+    def upload_content(self, filename, content, extra_args=None):
+        if extra_args is None:
+            extra_args = {}
+        extra_args["ACL"] = "public-read"
+        remote_name = self.get_key(filename)
+        if isinstance(content, bytes):
+            self.client.put_object(
+                Body=content, Bucket=self.bucket, Key=remote_name, **extra_args,
+            )
+        else:
+            self.client.upload_fileobj(
+                content, self.bucket, remote_name, ExtraArgs=extra_args,
+            )
         return remote_name
 
+    def list_objects(self, prefix=None):
+        if prefix is None:
+            prefix = self.prefix
+        paginator = self.client.get_paginator("list_objects_v2")
+        for page in paginator.paginate(Bucket=self.bucket, Prefix=prefix):
+            for obj in page.get("Contents", []):
+                yield obj
+
     def delete(self, key):
         self.client.delete_object(Bucket=self.bucket, Key=key)
+
+    def delete_many(self, keys, batch_size=1000):
+        # delete_objects accepts at most 1000 keys per request
+        client = self.client
+        keys = list(keys)
+        errors = []
+        for i in range(0, len(keys), batch_size):
+            objects = [{"Key": key} for key in keys[i:i + batch_size]]
+            resp = client.delete_objects(
+                Bucket=self.bucket, Delete={"Objects": objects, "Quiet": True},
+            )
+            errors.extend(resp.get("Errors", []))
+        return errors
+
+
+def get_mirrors(prefix=None):
+    # Buckets that receive a copy of every upload, see settings.S3_MIRRORS.
+    # Results and resume state are kept by name, so names must be unique.
+    mirrors = []
+    names = {"primary"}
+    for mirror in settings.S3_MIRRORS or []:
+        s3 = S3(**dict({"prefix": prefix}, **mirror))
+        if "name" not in mirror:
+            s3.name = "/".join(part for part in (s3.endpoint, s3.bucket) if part)
+        if s3.name in names:
+            raise ValueError(f"S3_MIRRORS: {s3.name} is used by more than one bucket, set a unique name")
+        names.add(s3.name)
+        mirrors.append(s3)
+    return mirrors
+
+
+class MultipartUpload(object):
+    # One destination of upload_multipart_to. With an upload_id, continues
+    # that upload and skips the parts S3 already has.
+    def __init__(self, s3, remote_name, extra_args, checksum, upload_id=None):
+        self.s3 = s3
+        self.remote_name = remote_name
+        self.checksum = checksum
+        self.pool = ThreadPoolExecutor(s3.workers)
+        self.pending = set()
+        self.parts = []
+        self.error = None
+        self.uploaded = {}
+        # When a part last completed, a mirror that stops making progress is dropped
+        self.progressed_on = time.monotonic()
+        if upload_id:
+            self.uploaded = s3.list_parts(remote_name, upload_id)
+            self.upload_id = upload_id
+            return
+        if checksum:
+            extra_args = dict(extra_args, ChecksumAlgorithm="CRC32", ChecksumType="FULL_OBJECT")
+        self.upload_id = s3.client.create_multipart_upload(
+            Bucket=s3.bucket, Key=remote_name, **extra_args,
+        )["UploadId"]
+
+    def has_part(self, part_number, md5):
+        # Parts uploaded by an earlier attempt are kept if they're intact
+        uploaded = self.uploaded.get(part_number)
+        if uploaded is None or uploaded["ETag"].strip('"') != md5.hexdigest():
+            return False
+        if self.checksum and "ChecksumCRC32" not in uploaded:
+            return False
+        part = {"PartNumber": part_number, "ETag": uploaded["ETag"]}
+        if self.checksum:
+            part["ChecksumCRC32"] = uploaded["ChecksumCRC32"]
+        self.parts.append(part)
+        return True
+
+    def get_state(self, size, part_size):
+        # Resuming asks S3 for the uploaded parts, they aren't kept here
+        return {
+            "key": self.remote_name,
+            "upload_id": self.upload_id,
+            "size": size,
+            "part_size": part_size,
+        }
+
+    def collect(self, max_pending=0, timeout=None):
+        # Waits until at most max_pending parts are in flight. With a timeout,
+        # gives up once no part completed for that many seconds.
+        while len(self.pending) > max_pending:
+            remaining = None
+            if timeout is not None:
+                remaining = max(0, self.progressed_on + timeout - time.monotonic())
+            done, self.pending = wait(self.pending, remaining, FIRST_COMPLETED)
+            if not done:
+                break
+            self.parts.extend(future.result() for future in done)
+            self.progressed_on = time.monotonic()
+
+    def add_part(self, part_number, data, md5, part_size, mirror=False):
+        # The primary is always waited for. A mirror may fall
+        # S3_MIRROR_MAX_BEHIND parts further behind, and fails instead of
+        # holding up the caller once it's stalled for S3_MIRROR_TIMEOUT.
+        max_pending = get_max_pending(self.s3, part_size)
+        timeout = None
+        if mirror:
+            max_pending += settings.S3_MIRROR_MAX_BEHIND
+            timeout = settings.S3_MIRROR_TIMEOUT
+        self.collect(max_pending - 1, timeout)
+        if len(self.pending) >= max_pending:
+            raise RuntimeError(f"{self.s3.name} made no progress for {timeout}s, {len(self.pending)} parts behind")
+        if not self.pending:
+            # Idle time between parts isn't a stall
+            self.progressed_on = time.monotonic()
+        self.pending.add(self.pool.submit(
+            self.s3._upload_part, self.remote_name, self.upload_id, part_number, data, md5, self.checksum,
+        ))
+
+    def complete(self, crc32):
+        self.collect()
+        kwargs = {}
+        if self.checksum:
+            kwargs["ChecksumCRC32"] = encode_crc32(crc32)
+            kwargs["ChecksumType"] = "FULL_OBJECT"
+        return self.s3.client.complete_multipart_upload(
+            Bucket=self.s3.bucket,
+            Key=self.remote_name,
+            UploadId=self.upload_id,
+            MultipartUpload={"Parts": sorted(self.parts, key=lambda part: part["PartNumber"])},
+            **kwargs,
+        )
+
+    def abort(self, error):
+        self.error = error
+        self.pool.shutdown(wait=True, cancel_futures=True)
+        try:
+            self.s3.client.abort_multipart_upload(
+                Bucket=self.s3.bucket, Key=self.remote_name, UploadId=self.upload_id,
+            )
+        except Exception:
+            log.error(f"Failed to abort upload of {self.remote_name} to {self.s3.name}", exc_info=True)
+
+    def stop(self):
+        # Leave the upload open to be resumed
+        self.pool.shutdown(wait=True, cancel_futures=True)
+        for future in self.pending:
+            if future.done() and not future.cancelled() and future.exception() is None:
+                self.parts.append(future.result())
+        self.pending = set()
+
+
+def get_max_pending(s3, part_size):
+    # Large parts mean fewer of them in flight
+    return max(1, min(s3.workers, settings.S3_UPLOAD_MEMORY // part_size))
+
+
+def drop_mirror(upload, error, filename):
+    log.error(f"Mirror {upload.s3.name} failed for {filename}", exc_info=error)
+    # Waits for the mirror's parts in flight, the primary doesn't
+    Thread(target=upload.abort, args=(error,), name=f"abort-{upload.s3.name}", daemon=True).start()
+
+
+def get_resumable(destinations, filename, size, resume):
+    # Upload IDs of resume that are still usable, by destination name, and
+    # their part size. Uploads that aren't are aborted.
+    part_size = None
+    upload_ids = {}
+    for s3 in destinations:
+        state = resume.get(s3.name)
+        if not state:
+            continue
+        usable = state["key"] == s3.get_key(filename) and state["size"] == size
+        if usable and part_size in (None, state["part_size"]):
+            part_size = state["part_size"]
+            upload_ids[s3.name] = state["upload_id"]
+            continue
+        try:
+            s3.abort_multipart(state["key"], state["upload_id"])
+        except Exception:
+            log.warning(f"Failed to abort old upload of {state['key']} to {s3.name}", exc_info=True)
+    return upload_ids, part_size
+
+
+def start_upload(s3, remote_name, extra_args, checksum, upload_id=None):
+    if upload_id:
+        try:
+            upload = MultipartUpload(s3, remote_name, extra_args, checksum, upload_id)
+            log.info(f"Resuming upload of {remote_name} to {s3.name}, {len(upload.uploaded)} parts done")
+            return upload
+        except ClientError as e:
+            if e.response["Error"]["Code"] != "NoSuchUpload":
+                raise
+            log.warning(f"Upload of {remote_name} to {s3.name} is gone, starting over")
+    return MultipartUpload(s3, remote_name, extra_args, checksum)
+
+
+def upload_multipart_to(destinations, filename, extra_args=None, part_size=None, checksum=None,
+                        resume=None, save_state=None):
+    # Read the file once, hashing each part while every destination uploads
+    # it. The first destination is the primary, if it fails the whole upload
+    # fails. A failed mirror is dropped and the others carry on. Returns the
+    # result or exception per destination name.
+    # save_state is called with the open uploads by destination name when
+    # they change and every few minutes while uploading, with the time in
+    # saved_on. Passing that back as resume continues them, and while it's
+    # set a failed upload is left open instead of being aborted.
+    if extra_args is None:
+        extra_args = {}
+    extra_args["ACL"] = "public-read"
+    size = os.path.getsize(filename)
+    upload_ids, resume_part_size = get_resumable(destinations, filename, size, resume or {})
+    part_size = resume_part_size or part_size or get_part_size(size)
+    if checksum is None:
+        checksum = settings.S3_CHECKSUM
+    results = {}
+    if size <= part_size:
+        with open(filename, "rb") as fp:
+            data = fp.read()
+        md5 = hashlib.md5(data)
+        crc32 = zlib.crc32(data)
+        for s3 in destinations:
+            bandwidth.consume(len(data))
+            try:
+                results[s3.name] = s3._put_single(s3.get_key(filename), data, md5, crc32, extra_args, checksum)
+            except Exception as e:
+                if s3 is destinations[0]:
+                    raise
+                results[s3.name] = e
+        return results
+
+    uploads = []
+    for s3 in destinations:
+        try:
+            uploads.append(start_upload(s3, s3.get_key(filename), extra_args, checksum, upload_ids.get(s3.name)))
+        except Exception as e:
+            if s3 is destinations[0]:
+                raise
+            results[s3.name] = e
+    primary = uploads[0]
+    md5s = []
+    crc32 = 0
+    saved = None
+    saved_on = 0
+
+    def save(force=False):
+        nonlocal saved, saved_on
+        if save_state is None:
+            return
+        state = {
+            upload.s3.name: upload.get_state(size, part_size)
+            for upload in uploads
+            if upload.s3.name not in results
+        }
+        # Only a dropped mirror changes it, saved_on tells cleanup_multipart
+        # the upload is still going
+        if not force and state == saved and time.monotonic() - saved_on < 300:
+            return
+        saved, saved_on = state, time.monotonic()
+        now = time.time()
+        save_state({name: dict(upload_state, saved_on=now) for name, upload_state in state.items()})
+
+    def fail(upload, error):
+        if upload is primary:
+            raise error
+        drop_mirror(upload, error, filename)
+        uploads.remove(upload)
+        results[upload.s3.name] = error
+
+    try:
+        with open(filename, "rb") as fp:
+            while True:
+                data = fp.read(part_size)
+                if not data:
+                    break
+                md5 = hashlib.md5(data)
+                md5s.append(md5)
+                crc32 = zlib.crc32(data, crc32)
+                for upload in list(uploads):
+                    if upload.has_part(len(md5s), md5):
+                        continue
+                    bandwidth.consume(len(data))
+                    try:
+                        upload.add_part(len(md5s), data, md5, part_size, mirror=upload is not primary)
+                    except Exception as e:
+                        fail(upload, e)
+                save(force=len(md5s) == 1)
+        for upload in list(uploads):
+            try:
+                resp = upload.complete(crc32)
+            except Exception as e:
+                fail(upload, e)
+                continue
+            upload.pool.shutdown()
+            results[upload.s3.name] = {
+                "key": upload.remote_name,
+                "etag": resp["ETag"],
+                "expected_etag": get_multipart_etag(md5s),
+                "crc32": crc32,
+                "part_size": part_size,
+            }
+    except Exception as e:
+        for upload in uploads:
+            if upload.s3.name in results:
+                continue
+            if save_state is None:
+                upload.abort(e)
+            else:
+                upload.stop()
+        if save_state is not None:
+            save(force=True)
+        raise
+    return results
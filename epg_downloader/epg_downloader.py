@@ -1,100 +1,256 @@
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+from datetime import datetime, timedelta, timezone
+import gzip
+import hashlib
 import json
 from logzero import logger as log
 import os
 from pathlib import Path
-from pymediainfo import MediaInfo
+from threading import Thread
+import time
+import zlib
 
-from .app import kv_store
-from .clients import S3
+from .app import checkpointing, database, get_entry_source, get_upload_key, kv_store, settings, sources
+from . import aio
+from .clients import S3, MultipartUpload, drop_mirror, get_mirrors, upload_multipart_to
+from .models import MISSING, SCHEMA_VERSION, EntryStats, Job, LocalFile, RecordingIndex, load_entry, migration
 from .utils import (
+    SIDECARS,
     check_crc,
     check_etag,
+    crc_in_log,
     epg_request,
     epg_retrieve,
     get_cdn_url,
     get_datetime,
     get_db_entries,
+    get_db_entries_by_status,
     get_db_entry,
     get_db_key,
     get_epg_entries,
     get_epg_file_url,
     get_epg_index_url,
     get_epg_info_url,
+    get_epg_log,
     get_epg_list_url,
     get_epg_free,
+    get_epg_info,
+    get_etag_part_sizes,
+    get_multipart_etag,
+    get_mediainfo_key,
+    get_quick_digest,
+    get_s3_keys,
     get_s3_origin_url,
+    is_entry_key,
+    iter_entries_with_raw,
     download_file,
+    hash_parts,
+    iter_epg_range,
+    iter_file,
+    iter_throttled,
+    parse_mediainfo,
 )
 
 Path
 
 
-def check_dl(identifier):
+search_enabled = RecordingIndex.fts5_installed()
+
+
+def get_entry_to_check(identifier):
     entry = get_entry(identifier)
-    log.info(entry['filename'], entry["id"])
-    is_valid = check_crc(entry['filename'], entry["id"])
+    LocalFile.touch(entry["db_key"])
+    return entry
+
+
+def check_dl(identifier, hash_pool=None):
+    entry = get_entry_to_check(identifier)
+    log.info(f"{entry['id']}: {entry['filename']}")
+    is_valid = check_crc(entry['filename'], entry["id"], hash_pool, get_entry_source(entry))
+    set_dl_checked(entry, is_valid)
+    return is_valid
+
+
+async def check_dl_async(engine, identifier, hash_pool=None):
+    # The DB work runs on the loop's default executor, not on the loop
+    entry = await aio.run_in(None, get_entry_to_check, identifier)
+    log.info(f"{entry['id']}: {entry['filename']}")
+    is_valid = await aio.check_crc(engine, entry['filename'], entry["id"], hash_pool, get_entry_source(entry))
+    await aio.run_in(None, set_dl_checked, entry, is_valid)
+    return is_valid
+
+
+def set_dl_checked(entry, is_valid):
     if is_valid:
         entry["epg_status"] = "downloaded"
         entry["local_status"] = "downloaded"
     else:
         entry["epg_status"] = "downloading_error"
     kv_store[entry["db_key"]] = entry
+
+
+def check_ul(identifier, hash_pool=None):
+    entry = get_entry_to_check(identifier)
+    is_valid = check_etag(entry['filename'], entry["web_origin_url"], hash_pool, entry.get("s3_part_size"))
+    set_ul_checked(entry, is_valid)
     return is_valid
 
 
-def check_ul(identifier):
-    entry = get_entry(identifier)
-    is_valid = check_etag(entry['filename'], entry["web_origin_url"])
+async def check_ul_async(engine, identifier, hash_pool=None):
+    entry = await aio.run_in(None, get_entry_to_check, identifier)
+    is_valid = await aio.check_etag(
+        engine, entry['filename'], entry["web_origin_url"], hash_pool, entry.get("s3_part_size"),
+    )
+    await aio.run_in(None, set_ul_checked, entry, is_valid)
+    return is_valid
+
+
+def set_ul_checked(entry, is_valid):
     if is_valid:
         entry["s3_status"] = "uploaded"
         entry["local_status"] = "uploaded"
     else:
         entry["s3_status"] = "upload_error"
     kv_store[entry["db_key"]] = entry
-    return is_valid
 
 
-def get_entries_to_download():
-    url = get_epg_list_url()
-    response = epg_retrieve(url)
-    for entry in get_epg_entries(response.json()):
+def get_entries_to_check(status="all", kind=None):
+    # Leaves out entries the kind of check can't pass: dl needs the log on
+    # EPGStation, ul needs an upload
+    for entry in get_db_entries_by_status(status):
+        if entry.get("local_status") == "deleted":
+            continue
+        if kind == "dl" and entry.get("epg_status") == "deleted":
+            continue
+        if kind == "ul" and "s3_key" not in entry:
+            continue
+        yield entry
+
+
+def check_all(entry_ids, dl=True, ul=False, jobs=None, hash_jobs=None, status=None):
+    # Network round-trips run on `jobs` threads. Hashing gets its own, smaller
+    # pool so the disks aren't thrashed (zlib/hashlib release the GIL).
+    # entry_ids get every check, with a status the entries it selects are
+    # added to the checks that apply to them.
+    checks = {}
+    if dl:
+        checks["dl"] = (check_dl, check_dl_async)
+    if ul:
+        checks["ul"] = (check_ul, check_ul_async)
+    selected = [(entry_id, kind) for entry_id in entry_ids for kind in checks]
+    if status is not None:
+        for kind in checks:
+            selected += [(entry["id"], kind) for entry in get_entries_to_check(status, kind)]
+    if aio.is_enabled():
+        with ThreadPoolExecutor(hash_jobs or settings.HASH_WORKERS) as hash_pool:
+            yield from aio.iter_completed(lambda engine: [
+                run_check_async(engine, checks[kind][1], entry_id, kind, hash_pool)
+                for entry_id, kind in selected
+            ])
+        return
+    with ThreadPoolExecutor(hash_jobs or settings.HASH_WORKERS) as hash_pool, \
+            ThreadPoolExecutor(jobs or settings.CHECK_WORKERS) as pool:
+        futures = {}
+        for entry_id, kind in selected:
+            futures[pool.submit(checks[kind][0], entry_id, hash_pool)] = (entry_id, kind)
+        for future in as_completed(futures):
+            entry_id, kind = futures[future]
+            try:
+                is_valid = future.result()
+            except Exception:
+                log.error(f"Failed checking {entry_id} {kind}", exc_info=True)
+                is_valid = False
+            yield entry_id, kind, is_valid
+
+
+async def run_check_async(engine, func, entry_id, kind, hash_pool):
+    try:
+        is_valid = await func(engine, entry_id, hash_pool)
+    except Exception:
+        log.error(f"Failed checking {entry_id} {kind}", exc_info=True)
+        is_valid = False
+    return entry_id, kind, is_valid
+
+
+def get_entries_to_download(source=None):
+    if source is None:
+        if aio.is_enabled():
+            # Fetch the lists of every source at once
+            for source, data in aio.iter_completed(lambda engine: [
+                fetch_epg_list_async(engine, source) for source in sources
+            ]):
+                yield from filter_new_entries(data, source)
+            return
+        for source in sources:
+            yield from get_entries_to_download(source)
+        return
+    url = get_epg_list_url(source)
+    response = epg_retrieve(url, source=source)
+    yield from filter_new_entries(response.json(), source)
+
+
+async def fetch_epg_list_async(engine, source):
+    _, body = await engine.epg_request("GET", get_epg_list_url(source), source)
+    return source, json.loads(body)
+
+
+def filter_new_entries(data, source):
+    for entry in get_epg_entries(data, source):
         filename = entry["filename"]
         json_filename = f"{filename}.json"
         entry["json_file"] = json_filename
-        db_key = get_db_key(entry["id"])
-        if db_key in kv_store.keys():
+        db_key = entry["db_key"]
+        if db_key in kv_store:
             log.info(f"Skipping download of {filename}")
             continue
         yield entry
 
 
-def update_from_epg(**kwargs):
-    for entry in get_entries_to_download():
+def update_from_epg(source=None, **kwargs):
+    if source is None:
+        # Sync every EPGStation at the same time
+        with ThreadPoolExecutor(len(sources)) as pool:
+            for future in [pool.submit(update_from_epg, source) for source in sources]:
+                future.result()
+        return
+    for entry in get_entries_to_download(source):
         db_key = entry['db_key']
         entry["epg_status"] = "-"
         kv_store[db_key] = entry
+        index_entry(entry)
+        Job.enqueue(db_key)
 
 
 def download_all_from_epg(force=True, **kwargs):
-    for entry in get_entries_to_download():
-        download_from_epg(entry)
-        try:
-            create_mediainfo(entry=entry)
-        except Exception:
-            log.error("Failed creating mediainfo", exc_info=True)
-        else:
-            delete_from_epg(entry=entry, force=force)
+    with ProcessPoolExecutor(settings.MEDIAINFO_WORKERS) as mediainfo_pool:
+        futures = []
+        for entry in get_entries_to_download():
+            if entry.get("recording"):
+                log.info(f"Skipping {entry['filename']}, still recording")
+                continue
+            download_from_epg(entry)
+            futures.append((entry, start_mediainfo(entry, mediainfo_pool)))
+        for entry, future in futures:
+            try:
+                finish_mediainfo(entry, future)
+            except Exception:
+                log.error("Failed creating mediainfo", exc_info=True)
+            else:
+                delete_from_epg(entry=entry, force=force)
 
 
 def download_from_epg(entry, **kwargs):
     db_key = entry['db_key']
     filename = entry["filename"]
+    source = get_entry_source(entry)
     json_filename = f"{filename}.json"
     log.info(f"Downloading {db_key}: {filename}")
+    evict_local(entry.get("filesize") or 0)
     entry["epg_status"] = "downloading"
     kv_store[db_key] = entry
+    started = time.monotonic()
     try:
-        download_file(entry["epg_file_url"], filename)
+        download_file(entry["epg_file_url"], filename, source, entry.get("filesize"))
     except Exception:
         log.error(f"Failed to download {db_key}: {filename}", exc_info=True)
         entry["epg_status"] = "downloading_error"
@@ -105,16 +261,18 @@ def download_from_epg(entry, **kwargs):
         kv_store[db_key] = entry
         log.warn(f"Failed download: {db_key}: {filename}")
         raise ValueError("filesize does not match")
-    if not check_crc(filename, entry["id"]):
+    if not check_crc(filename, entry["id"], source=source):
         entry["epg_status"] = "downloading_error"
         kv_store[db_key] = entry
         log.warn(f"Failed download: {db_key}: {filename}")
         raise ValueError("crc does not match")
     with open(json_filename, "w") as fp:
-        json.dump(entry, fp, indent=True, ensure_ascii=False)
+        json.dump(entry.to_dict(), fp, indent=True, ensure_ascii=False)
     entry["epg_status"] = "downloaded"
     entry["downloaded_on"] = get_datetime()
+    entry["download_seconds"] = round(time.monotonic() - started, 3)
     kv_store[db_key] = entry
+    index_entry(entry)
     log.info(f"Success download: {db_key}: {filename}")
 
 
@@ -123,7 +281,7 @@ def download_one_from_epg(identifier):
         key = get_db_key(int(identifier))
     except ValueError:
         key = identifier
-    entry = kv_store[key]
+    entry = load_entry(kv_store[key])
     return download_from_epg(entry)
 
 
@@ -152,59 +310,345 @@ def upload_one(entry_id):
     upload_to_s3(entry)
 
 
-def upload_to_s3(entry, force=False):
-    s3 = S3()
+def get_sidecar_content(entry, name):
+    filename = entry["filename"]
+    if name == "json":
+        return json.dumps(entry.to_dict(), indent=True, ensure_ascii=False).encode()
+    if name == "log":
+        log_file = Path(f"{filename}.log")
+        if log_file.is_file():
+            return log_file.read_bytes()
+        return get_epg_log(entry["id"], get_entry_source(entry)).encode()
+    if name == "mediainfo":
+        if "mediainfo_digest" in entry:
+            try:
+                return kv_store[get_mediainfo_key(entry["mediainfo_digest"])].encode()
+            except KeyError:
+                pass
+        return Path(f"{filename}.mediainfo.json").read_bytes()
+    raise ValueError(f"Unknown sidecar {name}")
+
+
+def upload_sidecar(s3, entry, name, compress=None):
+    if compress is None:
+        compress = settings.S3_GZIP_SIDECARS
+    suffix, content_type = SIDECARS[name]
+    content = get_sidecar_content(entry, name)
+    extra_args = {"ContentType": content_type}
+    if compress:
+        content = gzip.compress(content)
+        extra_args["ContentEncoding"] = "gzip"
+    return s3.upload_content(f"{entry['filename']}{suffix}", content, extra_args)
+
+
+def set_sidecar_status(entry, name, future):
+    status = entry.setdefault("sidecar_status", {})
+    try:
+        future.result()
+    except FileNotFoundError:
+        log.warning(f"No {name} sidecar for {entry['db_key']}")
+        status[name] = "missing"
+    except Exception:
+        log.error(f"Failed to upload {name} sidecar of {entry['db_key']}", exc_info=True)
+        status[name] = "upload_error"
+    else:
+        status[name] = "uploaded"
+        if name == "mediainfo":
+            entry["has_mediainfo"] = True
+    entry["sidecar_status"] = status
+
+
+def upload_sidecars(entry, names=None, s3=None):
+    if names is None:
+        names = list(SIDECARS)
+    if s3 is None:
+        s3 = S3(prefix=get_entry_source(entry).s3_prefix)
+    with ThreadPoolExecutor(len(names)) as pool:
+        futures = {pool.submit(upload_sidecar, s3, entry, name): name for name in names}
+        for future in as_completed(futures):
+            set_sidecar_status(entry, futures[future], future)
+    kv_store[entry["db_key"]] = entry
+
+
+def get_entries_with_failed_sidecars():
+    for entry in get_db_entries():
+        status = entry.get("sidecar_status", {})
+        failed = [name for name, value in status.items() if value != "uploaded"]
+        if entry.get("s3_status") == "uploaded" and failed:
+            yield entry, failed
+
+
+def set_mirror_status(entry, name, result):
+    status = entry.setdefault("mirror_status", {})
+    if isinstance(result, Exception):
+        log.error(f"Failed to mirror {entry['db_key']} to {name}: {result!r}")
+        status[name] = "upload_error"
+    elif result["etag"] != result["expected_etag"]:
+        log.error(f"Failed to mirror {entry['db_key']} to {name}: {result}")
+        status[name] = "upload_error"
+    else:
+        status[name] = "uploaded"
+    entry["mirror_status"] = status
+
+
+def upload_to_s3(entry, force=False, sidecars=None):
+    s3 = S3(prefix=get_entry_source(entry).s3_prefix)
+    mirrors = get_mirrors(s3.prefix)
     db_key = entry["db_key"]
     filename = entry["filename"]
     log.info(f"Uploading {db_key}: {filename} to S3")
+    LocalFile.touch(db_key)
     entry["s3_key"] = s3.get_key(filename)
     entry["s3_status"] = "uploading"
     kv_store[db_key] = entry
     log.info(f"Uploading {filename}")
-    json_file = f"{filename}.json"
-    log_file = f"{filename}.log"
-    mediainfo_file = f'{entry["filename"]}.mediainfo.json'
-    try:
-        s3.upload(json_file, {"ContentType": "application/json"})
-    except Exception:
-        pass
-    try:
-        s3.upload(log_file, {"ContentType": "text/plain; charset=utf-8"})
-    except Exception:
-        pass
-    try:
-        s3.upload(mediainfo_file, {"ContentType": "application/json"})
-    except Exception:
-        pass
+    if sidecars is None:
+        sidecars = list(SIDECARS)
+    upload_key = get_upload_key(db_key)
+
+    def save_state(state):
+        kv_store[upload_key] = state
+
+    started = time.monotonic()
+    # Sidecars are small, send them while the video is uploading
+    with ThreadPoolExecutor(len(sidecars) + 1) as pool:
+        # The file is read once for the primary and every mirror. Parts an
+        # earlier attempt got to S3 are skipped.
+        video = pool.submit(
+            upload_multipart_to, [s3] + mirrors, filename,
+            resume=kv_store.get(upload_key), save_state=save_state,
+        )
+        sidecars = {pool.submit(upload_sidecar, s3, entry, name): name for name in sidecars}
+        for future in as_completed(sidecars):
+            set_sidecar_status(entry, sidecars[future], future)
+        try:
+            results = video.result()
+        except Exception:
+            log.error(f"Failed to upload {db_key}: {filename}", exc_info=True)
+            entry["s3_status"] = "upload_error"
+            kv_store[db_key] = entry
+            raise
+    upload_seconds = round(time.monotonic() - started, 3)
+    if upload_key in kv_store:
+        del kv_store[upload_key]
+
+    result = results[s3.name]
+    for mirror in mirrors:
+        set_mirror_status(entry, mirror.name, results[mirror.name])
+
+    entry["web_origin_url"] = get_s3_origin_url(entry)
+    entry["web_cdn_url"] = get_cdn_url(entry)
+    entry["s3_etag"] = result["etag"]
+    entry["s3_part_size"] = result["part_size"]
+    entry["crc32"] = hex(result["crc32"])[2:]
+    # The parts were hashed while uploading, no need to read the file again
+    if result["etag"] != result["expected_etag"]:
+        log.error(f"Failed to upload {db_key}: {filename}: {result}")
+        entry["s3_status"] = "upload_error"
+        kv_store[db_key] = entry
+        raise ValueError(f"{db_key}: E-Tag does not match.")
+    log_file = Path(f"{filename}.log")
+    if log_file.is_file() and not crc_in_log(result["crc32"], log_file.read_text()):
+        log.error(f"Failed to upload {db_key}: {filename}: CRC32 {entry['crc32']} not in log")
+        entry["s3_status"] = "upload_error"
+        kv_store[db_key] = entry
+        raise ValueError(f"{db_key}: CRC32 does not match EPGStation log.")
+
+    entry["s3_status"] = "uploaded"
+    entry["local_status"] = "uploaded"
+    entry["uploaded_on"] = get_datetime()
+    entry["upload_seconds"] = upload_seconds
+    kv_store[db_key] = entry
+
+
+def cleanup_multipart(older_than=24 * 3600, dry_run=False):
+    # Aborts multipart uploads which can't be resumed: no entry is uploading
+    # them, or their resume state wasn't saved for older_than seconds, and
+    # they were started more than older_than seconds ago. Yields (bucket
+    # name, key, upload id) of each one.
+    kv_store.flush()
+    cutoff = datetime.now(timezone.utc) - timedelta(seconds=older_than)
+    resumable = set()
+    stale_keys = []
+    for key, state in kv_store.query(kv_store.key, kv_store.value).where(kv_store.key.startswith("upload_")):
+        try:
+            entry = get_entry(key[len("upload_"):])
+        except KeyError:
+            entry = None
+        saved_on = max((upload.get("saved_on", 0) for upload in state.values()), default=0)
+        if entry is None or entry.get("s3_status") == "uploaded" or saved_on < cutoff.timestamp():
+            stale_keys.append(key)
+            continue
+        resumable.update(upload["upload_id"] for upload in state.values())
+    destinations = {}
+    for source in sources:
+        for s3 in [S3(prefix=source.s3_prefix)] + get_mirrors(source.s3_prefix):
+            destinations[(s3.name, s3.bucket, s3.prefix)] = s3
+    for s3 in destinations.values():
+        for upload in s3.list_multipart_uploads():
+            if upload["UploadId"] in resumable or upload["Initiated"] > cutoff:
+                continue
+            if not dry_run:
+                s3.abort_multipart(upload["Key"], upload["UploadId"])
+            yield s3.name, upload["Key"], upload["UploadId"]
+    if not dry_run:
+        for key in stale_keys:
+            del kv_store[key]
+
+
+def tail_to_s3(entry):
+    # Download a recording while it's still being recorded, every part is
+    # uploaded as soon as it's complete. Returns once EPGStation has finished
+    # the recording and both copies are verified.
+    source = get_entry_source(entry)
+    s3 = S3(prefix=source.s3_prefix)
+    db_key = entry["db_key"]
+    filename = entry["filename"]
+    part_size = settings.TAIL_PART_SIZE
+    log.info(f"Tailing {db_key}: {filename}")
+    entry["s3_key"] = s3.get_key(filename)
+    entry["epg_status"] = "downloading"
+    entry["s3_status"] = "uploading"
+    kv_store[db_key] = entry
+    upload = MultipartUpload(s3, entry["s3_key"], {"ACL": "public-read"}, settings.S3_CHECKSUM)
+    # Mirrors get every part too, like in upload_multipart_to
+    uploads = [upload]
+    mirror_results = {}
+    for mirror in get_mirrors(s3.prefix):
+        try:
+            uploads.append(
+                MultipartUpload(mirror, mirror.get_key(filename), {"ACL": "public-read"}, settings.S3_CHECKSUM)
+            )
+        except Exception as e:
+            mirror_results[mirror.name] = e
+    md5s = []
+    crc32 = 0
+    size = 0
+    buf = bytearray()
+
+    def fail_mirror(mirror_upload, error):
+        drop_mirror(mirror_upload, error, filename)
+        uploads.remove(mirror_upload)
+        mirror_results[mirror_upload.s3.name] = error
+
+    def add_part(data):
+        md5 = hashlib.md5(data)
+        md5s.append(md5)
+        for part_upload in list(uploads):
+            try:
+                part_upload.add_part(len(md5s), data, md5, part_size, mirror=part_upload is not upload)
+            except Exception as e:
+                if part_upload is upload:
+                    raise
+                fail_mirror(part_upload, e)
+
     try:
-        s3.upload(filename)
-    except Exception:
-        log.error(f"Failed to upload {db_key}: {filename}", exc_info=True)
+        with open(filename, "wb") as fp:
+            while True:
+                # Checked first, so the last read gets everything once it's done
+                info = get_epg_info(entry["id"], source)
+                for chunk in iter_epg_range(entry["epg_file_url"], size, source):
+                    fp.write(chunk)
+                    size += len(chunk)
+                    crc32 = zlib.crc32(chunk, crc32)
+                    buf += chunk
+                    while len(buf) >= part_size:
+                        add_part(bytes(buf[:part_size]))
+                        del buf[:part_size]
+                if not info["recording"]:
+                    break
+                time.sleep(settings.TAIL_POLL_SECONDS)
+        if buf or not md5s:
+            add_part(bytes(buf))
+        resp = upload.complete(crc32)
+        upload.pool.shutdown()
+        for mirror_upload in uploads[1:]:
+            try:
+                mirror_resp = mirror_upload.complete(crc32)
+            except Exception as e:
+                fail_mirror(mirror_upload, e)
+                continue
+            mirror_upload.pool.shutdown()
+            mirror_results[mirror_upload.s3.name] = {
+                "etag": mirror_resp["ETag"], "expected_etag": get_multipart_etag(md5s, multipart=True),
+            }
+    except Exception as e:
+        log.error(f"Failed tailing {db_key}: {filename}", exc_info=True)
+        for part_upload in uploads:
+            if part_upload.s3.name not in mirror_results:
+                part_upload.abort(e)
+        entry["epg_status"] = "downloading_error"
         entry["s3_status"] = "upload_error"
         kv_store[db_key] = entry
         raise
 
-    entry["web_origin_url"] = get_s3_origin_url(entry)
-    entry["web_cdn_url"] = get_cdn_url(entry)
-    if not check_etag(entry['filename'], entry["web_origin_url"]):
-        log.error(f"Failed to upload {db_key}: {filename}", exc_info=True)
+    expected_etag = get_multipart_etag(md5s, multipart=True)
+    if info.get("filesize", size) != size:
+        error = ValueError(f"{db_key}: got {size} bytes, EPGStation has {info['filesize']}")
+    elif resp["ETag"] != expected_etag:
+        error = ValueError(f"{db_key}: E-Tag does not match.")
+    elif not crc_in_log(crc32, get_epg_log(entry["id"], source)):
+        error = ValueError(f"{db_key}: CRC32 does not match EPGStation log.")
+    else:
+        error = None
+    if error:
+        entry["epg_status"] = "downloading_error"
         entry["s3_status"] = "upload_error"
         kv_store[db_key] = entry
-        raise ValueError(f"{db_key}: E-Tag does not match.")
-        return
+        raise error
 
+    for name, result in mirror_results.items():
+        set_mirror_status(entry, name, result)
+    entry["recording"] = False
+    entry["filesize"] = size
+    entry["epg_status"] = "downloaded"
+    entry["downloaded_on"] = get_datetime()
+    entry["web_origin_url"] = get_s3_origin_url(entry)
+    entry["web_cdn_url"] = get_cdn_url(entry)
+    entry["s3_etag"] = resp["ETag"]
+    entry["s3_part_size"] = part_size
+    entry["crc32"] = hex(crc32)[2:]
     entry["s3_status"] = "uploaded"
     entry["local_status"] = "uploaded"
     entry["uploaded_on"] = get_datetime()
+    with open(f"{filename}.json", "w") as fp:
+        json.dump(entry.to_dict(), fp, indent=True, ensure_ascii=False)
     kv_store[db_key] = entry
+    index_entry(entry)
+    log.info(f"Success tailing {db_key}: {filename}")
+
+
+def upload_mediainfo_sidecar(entry, future):
+    try:
+        finish_mediainfo(entry, future)
+    except Exception:
+        log.error("Failed creating mediainfo", exc_info=True)
+    else:
+        upload_sidecars(entry, ["mediainfo"])
 
 
-def list_entries(status="all", fields=None, show_status=True, **kwargs):
+def get_field(entry, field, default=None):
+    # Falls back to the EPG payload, which is a query per entry
+    value = entry.get(field, MISSING)
+    return entry.raw.get(field, default) if value is MISSING else value
+
+
+def list_entries(status="all", fields=None, show_status=True, limit=None, sort=None, since=None, **kwargs):
     if fields is None:
         fields = ["name"]
-    for entry in get_db_entries(sort=True):
-        if status != "all" and entry.get("epg_status") != status and entry.get("s3_status") != status:
-            continue
+    entries = get_db_entries_by_status(status)
+    if since is not None:
+        # startAt is in milliseconds
+        since_ms = since.timestamp() * 1000
+        entries = (entry for entry in entries if entry.get("startAt", 0) >= since_ms)
+    if sort:
+        # Only sorting by key can be streamed, other fields need every entry
+        reverse = sort.startswith("-")
+        sort = sort.lstrip("-")
+        entries = sorted(entries, key=lambda entry: (get_field(entry, sort) is None, get_field(entry, sort)), reverse=reverse)
+    for i, entry in enumerate(entries):
+        if limit is not None and i >= limit:
+            break
         shown_entry = {"id": entry["id"]}
         if show_status:
             shown_entry.update(
@@ -219,47 +663,105 @@ def list_entries(status="all", fields=None, show_status=True, **kwargs):
                 size = int(entry["filesize"]) / (1024 * 1024 * 1024)
                 shown_entry[field] = f"{size:.2f}"
             else:
-                shown_entry[field] = entry.get(field, "-")
+                shown_entry[field] = get_field(entry, field, "-")
         yield shown_entry
 
 
 def get_info(identifier):
     entry = get_entry(identifier)
-    # Fix for version 0.3
-    has_changed = False
+    if entry.has_changes():
+        # Migrated while loading
+        kv_store[entry["db_key"]] = entry
+    return entry
+
+
+@migration(1)
+def migrate_v0_3(entry):
+    entry_id = entry["id"]
+    if entry.get("epg_status") == "uploaded":
+        entry["epg_status"] = "downloaded"
+        entry["local_status"] = "uploaded"
+        entry["s3_status"] = "uploaded"
+    if entry.get("s3_status") == "uploaded":
+        entry["local_status"] = "uploaded"
     if "s3_key" in entry:
         if "web_origin_url" not in entry:
             entry["web_origin_url"] = get_s3_origin_url(entry)
-            has_changed = True
         if "web_cdn_url" not in entry:
             entry["web_cdn_url"] = get_cdn_url(entry)
-            has_changed = True
-    if has_changed:
-        kv_store[entry["db_key"]] = entry
-    return entry
+    if "db_key" not in entry:
+        entry["db_key"] = entry["epg_key"]
+    if "epg_file_url" not in entry:
+        entry["epg_file_url"] = get_epg_file_url(entry_id, get_entry_source(entry))
+    if "epg_index_url" not in entry:
+        entry["epg_index_url"] = get_epg_index_url(entry_id, get_entry_source(entry))
 
 
-def migrate_data():
-    for entry in get_db_entries():
-        entry_id = entry["id"]
-        keys = entry.keys()
-        if entry["epg_status"] == "uploaded":
-            entry["epg_status"] = "downloaded"
-            entry["local_status"] = "uploaded"
-            entry["s3_status"] = "uploaded"
-        if entry.get("s3_status") == "uploaded":
-            entry["local_status"] = "uploaded"
-            if "web_origin_url" not in keys:
-                entry["web_origin_url"] = get_s3_origin_url(entry)
-            if "web_cdn_url" not in keys:
-                entry["web_cdn_url"] = get_cdn_url(entry)
-        if "epg_file_url" not in keys:
-            entry["epg_file_url"] = get_epg_file_url(entry_id)
-        if "epg_index_url" not in keys:
-            entry["epg_index_url"] = get_epg_index_url(entry_id)
-        if "db_key" not in keys:
-            entry["db_key"] = entry["epg_key"]
-        kv_store[entry["epg_key"]] = entry
+@migration(2)
+def migrate_recording(entry):
+    # recording became a hot field, copied out of the EPG payload once
+    if "recording" not in entry:
+        entry["recording"] = entry.raw.get("recording", False)
+
+
+def get_schema_state():
+    return kv_store.get("schema", {"version": 0})
+
+
+def migrate_data(batch_size=1000):
+    # Saves the entries still on an older schema, one transaction per batch.
+    # Progress is saved with every batch so an interrupted run resumes where
+    # it stopped. Yields (scanned, migrated) after each batch.
+    state = get_schema_state()
+    if state["version"] >= SCHEMA_VERSION:
+        return
+    last_key = state.get("last_key", "")
+    scanned = state.get("scanned", 0)
+    migrated = state.get("migrated", 0)
+    kv_store.flush()
+    while True:
+        rows = list(
+            kv_store.query(kv_store.key, kv_store.value)
+            .where(is_entry_key() & (kv_store.key > last_key))
+            .order_by(kv_store.key)
+            .limit(batch_size)
+        )
+        if not rows:
+            break
+        changed = {}
+        for key, value in rows:
+            entry = load_entry(value)
+            if entry.has_changes():
+                changed[key] = entry
+        last_key = rows[-1][0]
+        scanned += len(rows)
+        migrated += len(changed)
+        changed["schema"] = {
+            "version": state["version"], "last_key": last_key, "scanned": scanned, "migrated": migrated,
+        }
+        kv_store.save_many(changed)
+        kv_store.flush()
+        yield scanned, migrated
+    kv_store["schema"] = {"version": SCHEMA_VERSION, "migrated_on": get_datetime()}
+    kv_store.flush()
+
+
+def start_migration():
+    # Runs migrate_data in a background thread when the store is behind.
+    # Returns the thread or None.
+    if get_schema_state()["version"] >= SCHEMA_VERSION:
+        return None
+
+    def run():
+        try:
+            for scanned, migrated in migrate_data():
+                log.info(f"Schema migration: scanned {scanned}, migrated {migrated}")
+        except Exception:
+            log.error("Schema migration failed, it resumes on the next run", exc_info=True)
+
+    thread = Thread(target=run, name="migrate-data", daemon=True)
+    thread.start()
+    return thread
 
 
 def delete_local(*, entry=None, entry_id=None):
@@ -273,6 +775,41 @@ def delete_local(*, entry=None, entry_id=None):
             pass
     entry["local_status"] = "deleted"
     kv_store[db_key] = entry
+    LocalFile.forget(db_key)
+
+
+def get_local_file(entry):
+    # The local copy if it's still around, counts as a use for eviction
+    filename = entry["filename"]
+    if entry.get("local_status") == "deleted" or not os.path.isfile(filename):
+        return None
+    LocalFile.touch(entry["db_key"])
+    return filename
+
+
+def retain_local(entry):
+    # Keep the recording around after upload, the least recently used ones
+    # are deleted once the cache goes over LOCAL_CACHE_SIZE
+    if not settings.LOCAL_CACHE_SIZE or not os.path.isfile(entry["filename"]):
+        return delete_local(entry=entry)
+    LocalFile.touch(entry["db_key"], entry["filename"], os.path.getsize(entry["filename"]))
+    evict_local()
+
+
+def evict_local(needed=0):
+    # Make room for `needed` bytes
+    total = LocalFile.total_size()
+    for local_file in list(LocalFile.get_lru()):
+        if total + needed <= settings.LOCAL_CACHE_SIZE:
+            break
+        log.info(f"Evicting {local_file.db_key}: {local_file.filename}")
+        try:
+            delete_local(entry=load_entry(kv_store[local_file.db_key]))
+        except KeyError:
+            Path(local_file.filename).unlink(missing_ok=True)
+            LocalFile.forget(local_file.db_key)
+        total -= local_file.size
+    return total
 
 
 def delete_from_epg(*, entry=None, entry_id=None, force=False):
@@ -280,7 +817,8 @@ def delete_from_epg(*, entry=None, entry_id=None, force=False):
         entry = get_db_entry(entry_id)
     db_key = entry["db_key"]
     if force or entry["epg_status"] != "deleted":
-        epg_request(get_epg_info_url(entry["id"]), "DELETE")
+        source = get_entry_source(entry)
+        epg_request(get_epg_info_url(entry["id"], source), "DELETE", source=source)
     else:
         log.info(f"Skipped {entry['id']}")
     entry["epg_status"] = "deleted"
@@ -292,40 +830,305 @@ def delete_from_s3(*, entry=None, entry_id=None, force=False):
         entry = get_db_entry(entry_id)
     db_key = entry["db_key"]
     s3 = S3()
-    if force or entry["s3_status"] != "uploaded":
-        s3.delete(entry["s3_key"])
+    if force or entry.get("s3_status") != "deleted":
+        errors = s3.delete_many(get_s3_keys(entry))
+        if any(error["Key"] == entry["s3_key"] for error in errors):
+            raise ValueError(f"{db_key}: Failed deleting {entry['s3_key']}: {errors}")
     entry["s3_status"] = "deleted"
     kv_store[db_key] = entry
 
 
+def bulk_delete(*, local=(), epg=(), s3=(), force=False, jobs=None):
+    # Each argument is a list of entries to delete from that storage.
+    # Returns the ids which failed to be deleted per storage.
+    changed = {}
+    failed = {"local": [], "epg": [], "s3": []}
+
+    for entry in local:
+        if entry.get("local_status") != "deleted":
+            try:
+                os.unlink(entry["filename"])
+            except FileNotFoundError:
+                pass
+        entry["local_status"] = "deleted"
+        changed[entry["db_key"]] = entry
+        LocalFile.forget(entry["db_key"])
+
+    to_delete = [entry for entry in epg if force or entry["epg_status"] != "deleted"]
+    for entry, error in delete_all_from_epg(to_delete, jobs):
+        if error is not None:
+            log.error(f"Failed deleting {entry['id']} from EPGStation", exc_info=error)
+            failed["epg"].append(entry["id"])
+            continue
+        entry["epg_status"] = "deleted"
+        changed[entry["db_key"]] = entry
+
+    to_delete = [
+        entry for entry in s3
+        if "s3_key" in entry and (force or entry.get("s3_status") != "deleted")
+    ]
+    if to_delete:
+        errors = S3().delete_many(key for entry in to_delete for key in get_s3_keys(entry))
+        failed_keys = {error["Key"] for error in errors}
+        for error in errors:
+            log.error(f"Failed deleting {error['Key']} from S3: {error.get('Message')}")
+        for entry in to_delete:
+            if entry["s3_key"] in failed_keys:
+                failed["s3"].append(entry["id"])
+                continue
+            entry["s3_status"] = "deleted"
+            changed[entry["db_key"]] = entry
+
+    kv_store.save_many(changed)
+    return failed
+
+
+def delete_all_from_epg(entries, jobs=None):
+    # Yields (entry, exception or None) as the DELETEs complete
+    if aio.is_enabled():
+        yield from aio.iter_completed(lambda engine: [delete_from_epg_async(engine, entry) for entry in entries])
+        return
+    with ThreadPoolExecutor(jobs or settings.EPG_WORKERS) as pool:
+        futures = {}
+        for entry in entries:
+            source = get_entry_source(entry)
+            url = get_epg_info_url(entry["id"], source)
+            futures[pool.submit(epg_request, url, "DELETE", source=source)] = entry
+        for future in as_completed(futures):
+            try:
+                future.result().raise_for_status()
+            except Exception as e:
+                yield futures[future], e
+            else:
+                yield futures[future], None
+
+
+async def delete_from_epg_async(engine, entry):
+    source = get_entry_source(entry)
+    try:
+        await engine.epg_request("DELETE", get_epg_info_url(entry["id"], source), source)
+    except Exception as e:
+        return entry, e
+    return entry, None
+
+
+def reconcile_s3():
+    # Join a single listing of the bucket against the DB instead of a HEAD per entry
+    s3 = S3()
+    objects = {}
+    for prefix in {source.s3_prefix for source in sources}:
+        objects.update((obj["Key"], obj) for obj in s3.list_objects(prefix))
+    known_keys = set()
+    counts = {"uploaded": 0, "upload_error": 0, "missing": 0}
+    changed = []
+    for entry in get_db_entries():
+        if "s3_key" not in entry:
+            continue
+        keys = get_s3_keys(entry)
+        known_keys.update(keys)
+        if entry.get("s3_status") == "deleted" and keys[0] not in objects:
+            continue
+        obj = objects.get(keys[0])
+        if obj is None:
+            s3_status = "missing"
+        elif obj["Size"] != int(entry["filesize"]):
+            s3_status = "upload_error"
+        elif entry.get("s3_etag") and obj["ETag"] != entry["s3_etag"]:
+            s3_status = "upload_error"
+        else:
+            s3_status = "uploaded"
+        counts[s3_status] += 1
+        sidecar_status = {
+            name: "uploaded" if key in objects else "missing"
+            for name, key in zip(SIDECARS, keys[1:])
+        }
+        if s3_status != entry.get("s3_status") or sidecar_status != entry.get("sidecar_status"):
+            entry["s3_status"] = s3_status
+            entry["sidecar_status"] = sidecar_status
+            entry["has_mediainfo"] = sidecar_status["mediainfo"] == "uploaded"
+            changed.append(entry)
+    orphans = sorted(key for key in objects if key not in known_keys)
+    to_save = {entry["db_key"]: entry for entry in changed}
+    to_save["reconcile_s3"] = {
+        "reconciled_on": get_datetime(),
+        "counts": counts,
+        "orphans": orphans,
+    }
+    kv_store.save_many(to_save)
+    return {"counts": counts, "changed": len(changed), "orphans": orphans}
+
+
 def get_entry(identifier):
     try:
         key = get_db_key(int(identifier))
     except ValueError:
         key = identifier
-    return kv_store[key]
+    return load_entry(kv_store[key])
 
 
 def get_free_space():
-    data = get_epg_free()
-    free_gb = data["free"] / (1024 * 1024 * 1024)
-    total_gb = data["total"] / (1024 * 1024 * 1024)
-    percent = 100 * free_gb / total_gb
-    return f"Free: {percent:.2f}%  {free_gb:.2f}/{total_gb:.2f} GB"
+    lines = []
+    for source in sources:
+        data = get_epg_free(source)
+        free_gb = data["free"] / (1024 * 1024 * 1024)
+        total_gb = data["total"] / (1024 * 1024 * 1024)
+        percent = 100 * free_gb / total_gb
+        line = f"Free: {percent:.2f}%  {free_gb:.2f}/{total_gb:.2f} GB"
+        lines.append(line if len(sources) == 1 else f"{source.name}: {line}")
+    return "\n".join(lines)
+
+
+def index_entry(entry):
+    if search_enabled:
+        RecordingIndex.add(entry)
+
+
+def reindex_entries():
+    count = 0
+    kv_store.flush()
+    with database.atomic():
+        RecordingIndex.delete().execute()
+        for entry in get_db_entries():
+            RecordingIndex.add(entry)
+            count += 1
+    RecordingIndex.optimize()
+    return count
+
+
+def rebuild_stats():
+    # Entries saved before EntryStats existed
+    kv_store.flush()
+    count = 0
+    with database.atomic():
+        EntryStats.delete().execute()
+        batch = []
+        for entry in get_db_entries():
+            batch.append(entry)
+            if len(batch) >= 1000:
+                EntryStats.save_entries(batch)
+                count += len(batch)
+                batch = []
+        EntryStats.save_entries(batch)
+        count += len(batch)
+    return count
+
+
+def get_stats(group_by=()):
+    kv_store.flush()
+    # The write hook only adds the entries saved since the upgrade, backfill
+    # the rest whenever the counts disagree
+    if EntryStats.select().count() != kv_store.query().where(is_entry_key()).count():
+        rebuild_stats()
+    return list(EntryStats.aggregate(group_by))
+
+
+def get_updated_on(entry):
+    # Entries saved before updated_on existed
+    for key in ("updated_on", "uploaded_on", "downloaded_on"):
+        if entry.get(key):
+            return entry[key]
+    return ""
+
+
+def export_entries(stream, since=None):
+    count = 0
+    for entry in iter_entries_with_raw():
+        if since and get_updated_on(entry) < since:
+            continue
+        stream.write(json.dumps(entry.to_dict(), ensure_ascii=False, default=str))
+        stream.write("\n")
+        count += 1
+    return count
+
+
+def import_entries(stream, since=None, batch_size=5000):
+    # Upserts the entries of an export, batch_size per transaction. The
+    # updated_on of the export is kept so the data can be exported again.
+    count = 0
+    batch = {}
+
+    def save_batch():
+        kv_store.save_many(batch, touch=False)
+        kv_store.flush()
+        if search_enabled:
+            with database.atomic():
+                for entry in batch.values():
+                    RecordingIndex.add(entry)
+        batch.clear()
+
+    for line in stream:
+        if not line.strip():
+            continue
+        entry = load_entry(json.loads(line))
+        if "db_key" not in entry:
+            log.warning(f"Skipping entry without db_key: {entry.get('id')}")
+            continue
+        if since and get_updated_on(entry) < since:
+            continue
+        batch[entry["db_key"]] = entry
+        count += 1
+        if len(batch) >= batch_size:
+            save_batch()
+    if batch:
+        save_batch()
+    return count
+
+
+def search_entries(term, limit=20, raw=False):
+    for result in RecordingIndex.find(term, limit, raw):
+        try:
+            entry = get_entry(result.db_key)
+        except KeyError:
+            # Removed since it was indexed
+            continue
+        yield {
+            "id": entry["id"],
+            "epg": entry["epg_status"],
+            "s3": entry.get("s3_status", "-"),
+            "name": entry.get("name", "-"),
+            "score": f"{-result.score:.3g}",
+        }
+
+
+def gen_search_json(entries):
+    # Client-side search data for uploads.html, descriptions come from the
+    # index so the EPG payloads don't need loading
+    descriptions = {}
+    if search_enabled:
+        query = RecordingIndex.select(RecordingIndex.db_key, RecordingIndex.description)
+        descriptions = dict(query.tuples())
+    return json.dumps(
+        [
+            {
+                "name": entry["name"],
+                "url": entry["web_cdn_url"],
+                "description": descriptions.get(entry["db_key"], "")[:200],
+            }
+            for entry in entries
+        ],
+        ensure_ascii=False,
+    )
 
 
 def gen_html():
     fields = [
+        "db_key",
         "filename",
         "name",
         "size",
         "web_cdn_url",
         "web_origin_url",
+        "has_mediainfo",
     ]
     content = '<html>\n<meta charset="utf-8">\n<ul>'
+    entries = []
     for entry in list_entries(status="uploaded", fields=fields):
-        mediainfo_file = "{filename}.mediainfo.json".format(**entry)
-        if Path(mediainfo_file).is_file():
+        entries.append(entry)
+        has_mediainfo = entry["has_mediainfo"]
+        if has_mediainfo == "-":
+            # Entries uploaded before has_mediainfo was tracked
+            has_mediainfo = Path("{filename}.mediainfo.json".format(**entry)).is_file()
+        if has_mediainfo:
             content += """<li>
                 <a href="{web_cdn_url}">{name}</a>:&nbsp;
                 <a href="{web_cdn_url}.json">details</a>&nbsp;|&nbsp;
@@ -354,51 +1157,191 @@ def gen_html():
         fp.write(content)
     s3 = S3()
     s3.upload("uploads.html", {"ContentType": "text/html"})
+    s3.upload_content(
+        "search.json", gen_search_json(entries).encode(), {"ContentType": "application/json"},
+    )
     log.debug("Uploaded html")
 
 
+def start_mediainfo(entry, pool=None):
+    # Returns a future of the MediaInfo JSON, parsed in pool if given
+    filename = entry["filename"]
+    entry["mediainfo_digest"] = get_quick_digest(filename)
+    args = (filename, settings.MEDIAINFO_PARSE_SPEED, settings.MEDIAINFO_MAX_BYTES)
+    cached = kv_store.get(get_mediainfo_key(entry["mediainfo_digest"]))
+    if cached is None and pool is not None:
+        return pool.submit(parse_mediainfo, *args)
+    future = Future()
+    try:
+        future.set_result(cached if cached is not None else parse_mediainfo(*args))
+    except Exception as e:
+        future.set_exception(e)
+    return future
+
+
+def finish_mediainfo(entry, future):
+    try:
+        content = future.result()
+    except Exception:
+        entry["mediainfo_status"] = "error"
+        kv_store[entry["db_key"]] = entry
+        raise
+    kv_store[get_mediainfo_key(entry["mediainfo_digest"])] = content
+    with open(f"{entry['filename']}.mediainfo.json", "w") as fp:
+        fp.write(content)
+    entry["mediainfo_status"] = "generated"
+    kv_store[entry["db_key"]] = entry
+
+
 def create_mediainfo(entry=None, entry_id=None):
     if entry is None:
         entry = get_entry(entry_id)
-    filename = entry["filename"]
-    info = MediaInfo.parse(filename)
-    mediainfo_file = f"{filename}.mediainfo.json"
-    with open(mediainfo_file, "w") as fp:
-        fp.write(info.to_json())
+    LocalFile.touch(entry["db_key"])
+    finish_mediainfo(entry, start_mediainfo(entry))
 
 
 def upload_mediainfo(entry=None, entry_id=None):
-    s3 = S3()
     if entry is None:
         entry = get_entry(entry_id)
-    mediainfo_file = f'{entry["filename"]}.mediainfo.json'
-    try:
-        s3.upload(mediainfo_file, {"ContentType": "application/json"})
-    except Exception:
-        pass
+    upload_sidecars(entry, ["mediainfo"])
+
+
+def get_crc_from_s3(entry, s3=None):
+    # Read the retained local copy if there is one, otherwise stream the
+    # object once. Only the small .log touches the disk.
+    if s3 is None:
+        s3 = S3(prefix=get_entry_source(entry).s3_prefix)
+    filename = get_local_file(entry)
+    if filename and entry.get("s3_etag"):
+        etag = entry["s3_etag"]
+        size = os.path.getsize(filename)
+        chunks = iter_file(filename, settings.DOWNLOAD_BUFFER_SIZE)
+    else:
+        resp = s3.client.get_object(Bucket=s3.bucket, Key=entry["s3_key"])
+        etag = resp["ETag"]
+        size = resp["ContentLength"]
+        chunks = iter_throttled(resp["Body"].iter_chunks(settings.DOWNLOAD_BUFFER_SIZE))
+    part_sizes = get_etag_part_sizes(etag, size, entry.get("s3_part_size"))
+    hashers = hash_parts(chunks, part_sizes)
+    hasher = next((hasher for hasher in hashers if hasher.etag == etag), None)
+    if hasher is None:
+        raise ValueError(f"{entry['db_key']}: E-Tag {etag} does not match")
+    entry["s3_part_size"] = hasher.part_size
+    crc_str = hex(hasher.crc32)[2:]
+    with open(f"{entry['filename']}.log", "w") as fp:
+        fp.write(f"crc32: {crc_str}")
+    entry["crc32"] = crc_str
+    upload_sidecars(entry, ["log"], s3)
+    return crc_str
+
+
+def get_crc_all(entries, jobs=None):
+    with ThreadPoolExecutor(jobs or settings.CHECK_WORKERS) as pool:
+        futures = {pool.submit(get_crc_from_s3, entry): entry for entry in entries}
+        for future in as_completed(futures):
+            entry = futures[future]
+            try:
+                yield entry, future.result()
+            except Exception as e:
+                log.error(f"Failed getting CRC of {entry['db_key']}", exc_info=True)
+                yield entry, e
 
 
 def epg_to_s3_all():
-    dl_cnt = 0
-    for entry in get_entries_to_download():
-        try:
-            epg_to_s3(entry)
-        except Exception:
-            log.error("Failed downloading or uploading", exc_info=True)
-            continue
-        dl_cnt += 1
+    if settings.BACKGROUND_MIGRATION:
+        start_migration()
+    update_from_epg()
+    with ProcessPoolExecutor(settings.MEDIAINFO_WORKERS) as mediainfo_pool, checkpointing():
+        dl_cnt = run_jobs(mediainfo_pool)
     if dl_cnt:
         log.info(f"Downloaded {dl_cnt} files")
         # Generate HTML
         gen_html()
 
 
-def epg_to_s3(entry, force=True):
+def enqueue_failed_entries():
+    count = 0
+    for entry in get_db_entries():
+        if entry["epg_status"] in ("downloading", "downloading_error"):
+            Job.enqueue(entry["db_key"], "download", reset=True)
+        elif entry.get("s3_status") in ("uploading", "upload_error"):
+            Job.enqueue(entry["db_key"], "upload", reset=True)
+        else:
+            continue
+        count += 1
+    return count
+
+
+def run_job(job, mediainfo_pool=None, mediainfo=None):
+    if mediainfo is None:
+        mediainfo = {}
+    entry = load_entry(kv_store[job.db_key])
+    stage = None
+    if job.stage == "download" and entry.get("recording") and settings.TAIL_RECORDINGS:
+        tail_to_s3(entry)
+        upload_sidecars(entry, [name for name in SIDECARS if name != "mediainfo"])
+        upload_mediainfo_sidecar(entry, start_mediainfo(entry, mediainfo_pool))
+        # Already uploaded
+        stage = "cleanup"
+    elif job.stage == "download":
+        download_from_epg(entry)
+        mediainfo[job.db_key] = start_mediainfo(entry, mediainfo_pool)
+    elif job.stage == "upload":
+        upload_to_s3(entry, sidecars=[name for name in SIDECARS if name != "mediainfo"])
+        upload_mediainfo_sidecar(entry, mediainfo.pop(job.db_key, None) or start_mediainfo(entry))
+    elif job.stage == "cleanup":
+        retain_local(entry)
+        delete_from_epg(entry=entry, force=True)
+    # The job only advances once the entry is saved, a failed save fails it
+    kv_store.flush()
+    return stage
+
+
+def run_source_jobs(source, worker_id, mediainfo_pool=None, mediainfo=None):
+    # A job keeps its place in the queue when it advances, so a recording
+    # goes through every stage before the next download starts.
+    done = 0
+    with database.connection_context():
+        while True:
+            job = Job.claim(worker_id, source.key_prefix)
+            if job is None:
+                break
+            log.info(f"Running {job.stage} of {job.db_key} (attempt {job.attempts + 1})")
+            try:
+                with job.heartbeat():
+                    stage = run_job(job, mediainfo_pool, mediainfo)
+            except Exception as e:
+                log.error(f"Failed {job.stage} of {job.db_key}", exc_info=True)
+                job.fail(repr(e))
+                continue
+            job.advance(stage)
+            if job.status == "done":
+                done += 1
+    return done
+
+
+def run_jobs(mediainfo_pool=None):
+    # Each source gets as many workers as its concurrency limit. Jobs are
+    # claimed with a lease in the DB, so other processes can share the queue.
+    mediainfo = {}
+    workers = [
+        (source, f"{settings.WORKER_ID}:{source.name}:{i}")
+        for source in sources
+        for i in range(source.workers)
+    ]
+    with ThreadPoolExecutor(len(workers)) as pool:
+        futures = [
+            pool.submit(run_source_jobs, source, worker_id, mediainfo_pool, mediainfo)
+            for source, worker_id in workers
+        ]
+        return sum(future.result() for future in futures)
+
+
+def epg_to_s3(entry, force=True, mediainfo_pool=None):
     download_from_epg(entry)
-    try:
-        create_mediainfo(entry=entry)
-    except Exception:
-        log.error("Failed creating mediainfo", exc_info=True)
-    upload_to_s3(entry)
-    delete_local(entry=entry)
+    # MediaInfo is parsed while the video uploads, its sidecar follows after
+    mediainfo = start_mediainfo(entry, mediainfo_pool)
+    upload_to_s3(entry, sidecars=[name for name in SIDECARS if name != "mediainfo"])
+    upload_mediainfo_sidecar(entry, mediainfo)
+    retain_local(entry)
     delete_from_epg(entry=entry, force=force)
@@ -0,0 +1,572 @@
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+import hashlib
+from threading import Event, Thread
+
+from logzero import logger as log
+from peewee import (
+    SQL,
+    BigIntegerField,
+    Case,
+    CharField,
+    DateTimeField,
+    FloatField,
+    IntegerField,
+    Model,
+    OperationalError,
+    TextField,
+    fn,
+)
+from playhouse.migrate import SqliteMigrator, migrate
+from playhouse.sqlite_ext import FTS5Model, SearchField
+
+from .app import database, get_raw_key, kv_store, settings
+
+
+# Read on every listing/upload pass, so kept directly on the entry. Anything
+# else we store goes in Entry.extra, the EPGStation payload is kept apart and
+# only loaded when it's read through Entry.raw.
+HOT_FIELDS = (
+    "id",
+    "db_key",
+    "source",
+    "name",
+    "filename",
+    "filesize",
+    "channelId",
+    "startAt",
+    "endAt",
+    "epg_status",
+    "local_status",
+    "s3_status",
+    "s3_key",
+    "s3_etag",
+    "web_origin_url",
+    "web_cdn_url",
+    "downloaded_on",
+    "uploaded_on",
+    "has_mediainfo",
+    "recording",
+)
+# Fields we add to entries (not from EPGStation), used to split old dict entries
+OPERATIONAL_FIELDS = (
+    "json_file",
+    "epg_key",
+    "epg_file_url",
+    "epg_index_url",
+    "crc32",
+    "s3_part_size",
+    "sidecar_status",
+    "mirror_status",
+    "mediainfo_digest",
+    "mediainfo_status",
+    "download_seconds",
+    "upload_seconds",
+    "schema_version",
+    "updated_on",
+)
+
+
+class _Missing(object):
+    def __reduce__(self):
+        return "MISSING"
+
+    def __repr__(self):
+        return "MISSING"
+
+
+MISSING = _Missing()
+HOT_INDEX = {name: i for i, name in enumerate(HOT_FIELDS)}
+OPERATIONAL_SET = frozenset(OPERATIONAL_FIELDS)
+
+
+# Bump when adding a migration. Entries are migrated when they're loaded and
+# saved with the next write, migrate_data() does all of them in batches.
+SCHEMA_VERSION = 2
+MIGRATIONS = {}
+
+
+def migration(version):
+    def register(func):
+        MIGRATIONS[version] = func
+        return func
+    return register
+
+
+def _restore_entry(values, extra):
+    if len(values) < len(HOT_FIELDS):
+        # Pickled before fields were added to HOT_FIELDS
+        values = values + [MISSING] * (len(HOT_FIELDS) - len(values))
+    entry = Entry.__new__(Entry)
+    entry.values = values
+    entry.extra = extra
+    entry._raw = MISSING
+    entry._raw_dirty = False
+    entry._changed = set()
+    return entry
+
+
+class Entry(object):
+    # values holds HOT_FIELDS in order, so restoring one from the DB is a
+    # handful of assignments instead of rebuilding a large dict
+    __slots__ = ("values", "extra", "_raw", "_raw_dirty", "_changed")
+
+    def __init__(self, raw=None, **fields):
+        self.values = [MISSING] * len(HOT_FIELDS)
+        self.extra = {}
+        self._raw = MISSING if raw is None else raw
+        self._raw_dirty = raw is not None
+        # None until the entry is first saved as a whole
+        self._changed = None
+        for key, value in fields.items():
+            self[key] = value
+
+    @classmethod
+    def from_epg(cls, payload):
+        entry = cls(raw=dict(payload))
+        for name, i in HOT_INDEX.items():
+            if name in payload:
+                entry.values[i] = payload[name]
+        entry.extra["schema_version"] = SCHEMA_VERSION
+        return entry
+
+    @classmethod
+    def from_dict(cls, data):
+        # Entries saved as plain dicts before Entry existed
+        if isinstance(data, cls):
+            return data
+        raw = {}
+        entry = cls()
+        for key, value in data.items():
+            if key in HOT_INDEX or key in OPERATIONAL_SET:
+                entry[key] = value
+            else:
+                raw[key] = value
+        entry._raw = raw
+        entry._raw_dirty = True
+        return entry
+
+    def __reduce__(self):
+        # The raw payload is saved under its own key, see pop_unsaved_raw
+        return _restore_entry, (self.values, self.extra)
+
+    @property
+    def raw(self):
+        if self._raw is MISSING:
+            db_key = self.values[HOT_INDEX["db_key"]]
+            self._raw = {} if db_key is MISSING else kv_store.get(get_raw_key(db_key), {})
+        return self._raw
+
+    def pop_unsaved_raw(self):
+        if not self._raw_dirty:
+            return None
+        self._raw_dirty = False
+        return self._raw
+
+    def has_changes(self):
+        return self._changed is None or bool(self._changed)
+
+    def pop_changes(self):
+        # Fields set since the entry was loaded/last saved, None if the whole
+        # entry has to be saved
+        changed, self._changed = self._changed, set()
+        if changed is None:
+            return None
+        return {key: self[key] for key in changed}
+
+    def __getitem__(self, key):
+        i = HOT_INDEX.get(key)
+        if i is not None:
+            value = self.values[i]
+            if value is MISSING:
+                raise KeyError(key)
+            return value
+        if key in self.extra:
+            return self.extra[key]
+        # The EPGStation payload is only loaded through self.raw, so looking
+        # up a missing field never costs a query per entry
+        raise KeyError(key)
+
+    def __setitem__(self, key, value):
+        i = HOT_INDEX.get(key)
+        if i is not None:
+            self.values[i] = value
+        else:
+            self.extra[key] = value
+        if self._changed is not None:
+            self._changed.add(key)
+
+    def __contains__(self, key):
+        try:
+            self[key]
+        except KeyError:
+            return False
+        return True
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def setdefault(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            self[key] = default
+            return default
+
+    def keys(self):
+        return self.to_dict().keys()
+
+    def to_dict(self):
+        data = dict(self.raw)
+        data.update(self.extra)
+        for name, value in zip(HOT_FIELDS, self.values):
+            if value is not MISSING:
+                data[name] = value
+        return data
+
+    def __repr__(self):
+        return f"<Entry {self.get('db_key')}: {self.get('name')}>"
+
+
+def load_entry(value):
+    entry = Entry.from_dict(value)
+    version = entry.get("schema_version", 0)
+    while version < SCHEMA_VERSION and version + 1 in MIGRATIONS:
+        version += 1
+        MIGRATIONS[version](entry)
+        entry["schema_version"] = version
+    return entry
+
+
+class BaseModel(Model):
+    class Meta:
+        database = database
+
+
+def get_backoff(attempts):
+    seconds = settings.JOB_BACKOFF_SECONDS * 2 ** (attempts - 1)
+    return timedelta(seconds=min(seconds, settings.JOB_BACKOFF_MAX_SECONDS))
+
+
+class Job(BaseModel):
+    STAGES = ("download", "upload", "cleanup", "done")
+
+    db_key = CharField(unique=True)
+    stage = CharField(default="download")
+    # pending, failed (gave up after JOB_MAX_ATTEMPTS) or done
+    status = CharField(default="pending", index=True)
+    attempts = IntegerField(default=0)
+    next_run_on = DateTimeField(default=datetime.now, index=True)
+    last_error = TextField(null=True)
+    updated_on = DateTimeField(default=datetime.now)
+    # Set while a worker holds the job, other workers skip it until the
+    # lease expires (e.g. the worker crashed)
+    worker_id = CharField(null=True)
+    lease_expires_on = DateTimeField(null=True)
+
+    @classmethod
+    def enqueue(cls, db_key, stage="download", reset=False):
+        now = datetime.now()
+        query = cls.insert(
+            db_key=db_key, stage=stage, status="pending", next_run_on=now, updated_on=now,
+        )
+        if not reset:
+            return query.on_conflict_ignore().execute()
+        return query.on_conflict(
+            conflict_target=[cls.db_key],
+            update={
+                cls.stage: stage,
+                cls.status: "pending",
+                cls.attempts: 0,
+                cls.next_run_on: now,
+                cls.last_error: None,
+                cls.updated_on: now,
+                cls.worker_id: None,
+                cls.lease_expires_on: None,
+            },
+        ).execute()
+
+    @classmethod
+    def get_due(cls, key_prefix=None):
+        query = cls.select().where((cls.status == "pending") & (cls.next_run_on <= datetime.now()))
+        if key_prefix is not None:
+            query = query.where(cls.db_key.startswith(f"{key_prefix}_"))
+        return query.order_by(cls.next_run_on, cls.id)
+
+    @classmethod
+    def is_free(cls, now):
+        return cls.lease_expires_on.is_null() | (cls.lease_expires_on < now)
+
+    @classmethod
+    def claim(cls, worker_id, key_prefix=None):
+        now = datetime.now()
+        lease_expires_on = now + timedelta(seconds=settings.JOB_LEASE_SECONDS)
+        for job in cls.get_due(key_prefix).where(cls.is_free(now)).limit(10):
+            # Compare-and-set, only one worker can win the update
+            claimed = cls.update(
+                worker_id=worker_id, lease_expires_on=lease_expires_on,
+            ).where(
+                (cls.id == job.id) & (cls.stage == job.stage) & (cls.status == "pending") & cls.is_free(now)
+            ).execute()
+            if claimed:
+                job.worker_id = worker_id
+                job.lease_expires_on = lease_expires_on
+                return job
+
+    def update_owned(self, **fields):
+        # Only the worker holding the lease can change the job
+        updated = type(self).update(**fields).where(
+            (type(self).id == self.id) & (type(self).worker_id == self.worker_id)
+        ).execute()
+        if not updated:
+            log.warning(f"Lost lease on {self.db_key} ({self.worker_id})")
+            return False
+        for name, value in fields.items():
+            setattr(self, name, value)
+        return True
+
+    def renew_lease(self):
+        return self.update_owned(
+            lease_expires_on=datetime.now() + timedelta(seconds=settings.JOB_LEASE_SECONDS),
+        )
+
+    @contextmanager
+    def heartbeat(self):
+        stopped = Event()
+
+        def beat():
+            while not stopped.wait(settings.JOB_LEASE_SECONDS / 3):
+                if not self.renew_lease():
+                    return
+
+        thread = Thread(target=beat, daemon=True)
+        thread.start()
+        try:
+            yield self
+        finally:
+            stopped.set()
+            thread.join()
+
+    def advance(self, stage=None):
+        # stage skips ahead, e.g. a tailed recording is uploaded while downloading
+        stage = stage or self.STAGES[self.STAGES.index(self.stage) + 1]
+        return self.update_owned(
+            stage=stage,
+            status="done" if stage == "done" else self.status,
+            attempts=0,
+            last_error=None,
+            updated_on=datetime.now(),
+            worker_id=None,
+            lease_expires_on=None,
+        )
+
+    def fail(self, error):
+        attempts = self.attempts + 1
+        now = datetime.now()
+        fields = {
+            "attempts": attempts,
+            "last_error": error,
+            "updated_on": now,
+            "worker_id": None,
+            "lease_expires_on": None,
+        }
+        if attempts >= settings.JOB_MAX_ATTEMPTS:
+            fields["status"] = "failed"
+        else:
+            fields["next_run_on"] = now + get_backoff(attempts)
+        return self.update_owned(**fields)
+
+
+class LocalFile(BaseModel):
+    # Recordings kept in DIRECTORY after upload, evicted least recently used
+    # first once they take more than LOCAL_CACHE_SIZE
+    db_key = CharField(unique=True)
+    filename = TextField()
+    size = BigIntegerField(default=0)
+    accessed_on = DateTimeField(default=datetime.now, index=True)
+
+    @classmethod
+    def touch(cls, db_key, filename=None, size=None):
+        fields = {cls.accessed_on: datetime.now()}
+        if filename is None:
+            return cls.update(fields).where(cls.db_key == db_key).execute()
+        fields.update({cls.filename: filename, cls.size: size})
+        return cls.insert(
+            db_key=db_key, filename=filename, size=size,
+        ).on_conflict(conflict_target=[cls.db_key], update=fields).execute()
+
+    @classmethod
+    def total_size(cls):
+        return cls.select(fn.COALESCE(fn.SUM(cls.size), 0)).scalar()
+
+    @classmethod
+    def get_lru(cls):
+        return cls.select().order_by(cls.accessed_on, cls.id)
+
+    @classmethod
+    def forget(cls, db_key):
+        return cls.delete().where(cls.db_key == db_key).execute()
+
+
+class EntryStats(BaseModel):
+    # Columns of each entry that stats aggregates in SQL. Kept in sync by the
+    # kv_store writer, in the same transaction as the entry.
+    db_key = CharField(unique=True)
+    source = CharField(null=True)
+    channel = CharField(null=True, index=True)
+    start_at = DateTimeField(null=True, index=True)
+    filesize = BigIntegerField(default=0)
+    epg_status = CharField(null=True)
+    local_status = CharField(null=True)
+    s3_status = CharField(null=True)
+    download_seconds = FloatField(null=True)
+    upload_seconds = FloatField(null=True)
+
+    GROUPS = {
+        "channel": channel,
+        "month": fn.strftime("%Y-%m", start_at),
+        "source": source,
+        # Not uploaded yet falls back to where the download is
+        "status": fn.COALESCE(s3_status, epg_status),
+        "epg_status": epg_status,
+        "local_status": local_status,
+        "s3_status": s3_status,
+    }
+
+    @classmethod
+    def get_row(cls, entry):
+        start_at = entry.get("startAt")
+        return {
+            "db_key": entry["db_key"],
+            "source": entry.get("source"),
+            "channel": None if entry.get("channelId") is None else str(entry.get("channelId")),
+            "start_at": None if start_at is None else str(datetime.fromtimestamp(start_at // 1000)),
+            "filesize": int(entry.get("filesize") or 0),
+            "epg_status": entry.get("epg_status"),
+            "local_status": entry.get("local_status"),
+            "s3_status": entry.get("s3_status"),
+            "download_seconds": entry.get("download_seconds"),
+            "upload_seconds": entry.get("upload_seconds"),
+        }
+
+    @classmethod
+    def save_entries(cls, entries):
+        rows = [cls.get_row(entry) for entry in entries if isinstance(entry, Entry)]
+        if not rows:
+            return
+        # Building a large INSERT takes peewee longer than SQLite needs to
+        # run it, use a single prepared statement instead
+        columns = list(rows[0])
+        sql = "INSERT OR REPLACE INTO {} ({}) VALUES ({})".format(
+            cls._meta.table_name,
+            ", ".join(f'"{column}"' for column in columns),
+            ", ".join("?" for _ in columns),
+        )
+        cls._meta.database.cursor().executemany(sql, [tuple(row.values()) for row in rows])
+
+    @classmethod
+    def sum_if(cls, condition, value=None):
+        return fn.SUM(Case(None, [(condition, cls.filesize if value is None else value)], 0))
+
+    @classmethod
+    def aggregate(cls, group_by=()):
+        groups = [cls.GROUPS[name].alias(name) for name in group_by]
+        on_epg = fn.COALESCE(cls.epg_status, "") != "deleted"
+        is_local = (
+            ((cls.epg_status == "downloaded") | cls.local_status.in_(["downloaded", "uploaded"]))
+            & (fn.COALESCE(cls.local_status, "") != "deleted")
+        )
+        downloaded = cls.download_seconds > 0
+        uploaded = cls.upload_seconds > 0
+        query = cls.select(
+            *groups,
+            fn.COUNT(cls.id).alias("count"),
+            fn.SUM(cls.filesize).alias("bytes"),
+            cls.sum_if(on_epg).alias("epg_bytes"),
+            cls.sum_if(is_local).alias("local_bytes"),
+            cls.sum_if(cls.s3_status == "uploaded").alias("s3_bytes"),
+            # Bytes per second over everything with a recorded duration
+            (cls.sum_if(downloaded) / fn.NULLIF(cls.sum_if(downloaded, cls.download_seconds), 0))
+            .cast("INTEGER").alias("download_rate"),
+            (cls.sum_if(uploaded) / fn.NULLIF(cls.sum_if(uploaded, cls.upload_seconds), 0))
+            .cast("INTEGER").alias("upload_rate"),
+        )
+        if groups:
+            query = query.group_by(*groups).order_by(*groups)
+        return query.dicts()
+
+
+def get_index_rowid(db_key):
+    # FTS5 tables are keyed by an integer rowid, db_keys are unique strings
+    digest = hashlib.blake2b(db_key.encode(), digest_size=8).digest()
+    return int.from_bytes(digest, "big") >> 1
+
+
+class RecordingIndex(FTS5Model):
+    db_key = SearchField(unindexed=True)
+    name = SearchField()
+    description = SearchField()
+    extended = SearchField()
+    channel = SearchField()
+
+    class Meta:
+        database = database
+        # trigram matches inside Japanese text which has no word breaks
+        options = {"tokenize": settings.FTS_TOKENIZE}
+
+    @classmethod
+    def add(cls, entry):
+        raw = entry.raw
+        channel = f"{raw.get('channelType', '')} {entry.get('channelId', '')}"
+        return cls.insert(
+            rowid=get_index_rowid(entry["db_key"]),
+            db_key=entry["db_key"],
+            name=entry.get("name", ""),
+            description=raw.get("description", ""),
+            extended=raw.get("extended", ""),
+            channel=channel.strip(),
+        ).on_conflict_replace().execute()
+
+    @classmethod
+    def find(cls, term, limit=20, raw=False):
+        if not raw:
+            # Search for the text as is, not as an FTS5 query
+            term = '"{}"'.format(term.replace('"', '""'))
+        return (
+            cls.select(cls.db_key, cls.name, cls.rank().alias("score"))
+            .where(cls.match(term))
+            .order_by(SQL("score"))
+            .limit(limit)
+        )
+
+
+def migrate_tables():
+    columns = {column.name for column in database.get_columns(Job._meta.table_name)}
+    migrator = SqliteMigrator(database)
+    operations = [
+        migrator.add_column(Job._meta.table_name, field.column_name, field)
+        for field in (Job.worker_id, Job.lease_expires_on)
+        if field.column_name not in columns
+    ]
+    if operations:
+        migrate(*operations)
+
+
+def create_tables():
+    database.create_tables([Job, LocalFile, EntryStats])
+    if RecordingIndex.fts5_installed():
+        try:
+            RecordingIndex.create_table()
+        except OperationalError:
+            # trigram needs SQLite 3.34
+            log.warning(f"SQLite has no {settings.FTS_TOKENIZE} tokenizer, search uses unicode61")
+            RecordingIndex._meta.options["tokenize"] = "unicode61"
+            RecordingIndex.create_table()
+    migrate_tables()
+
+
+create_tables()
+kv_store.write_hooks.append(lambda rows: EntryStats.save_entries(rows.values()))
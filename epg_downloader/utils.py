@@ -1,14 +1,90 @@
+import base64
+from contextlib import contextmanager
+import csv
 from datetime import datetime
+from functools import reduce
+import gzip
 import hashlib
+import io
+import json
 import logging
+import operator
+import os
+from pymediainfo import MediaInfo
+import sys
+from threading import Lock
+import time
+import unicodedata
 from urllib.parse import unquote_plus, quote
 import requests
 import zlib
 
-from .app import kv_store, settings
+from .app import database, get_source, kv_store, settings, sources
+from .models import Entry, load_entry
 
 log = logging.getLogger(__name__)
 
+# Name: (suffix, content type)
+SIDECARS = {
+    "json": (".json", "application/json"),
+    "log": (".log", "text/plain; charset=utf-8"),
+    "mediainfo": (".mediainfo.json", "application/json"),
+}
+SIDECAR_SUFFIXES = tuple(suffix for suffix, _ in SIDECARS.values())
+
+
+# S3 doesn't allow more parts than this in a multipart upload
+S3_MAX_PARTS = 10000
+
+
+def get_part_size(filesize):
+    # Big recordings get fewer, larger parts
+    part_size = settings.S3_PART_SIZE
+    while part_size < settings.S3_MAX_PART_SIZE and filesize > part_size * settings.S3_TARGET_PARTS:
+        part_size *= 2
+    part_size = min(part_size, max(settings.S3_MAX_PART_SIZE, settings.S3_PART_SIZE))
+    if filesize > part_size * S3_MAX_PARTS:
+        part_size = -(-filesize // S3_MAX_PARTS)
+    return part_size
+
+
+def get_etag_part_sizes(etag, size, part_size=None):
+    # Part sizes which give the "-N" part count of the ETag for an object of
+    # this size (all parts but the last are the same size), most likely first
+    etag = etag.strip('"')
+    if "-" not in etag:
+        return [max(size, 1)]
+    parts = int(etag.rsplit("-", 1)[1])
+    mib = 1024 * 1024
+    candidates = [part_size, get_part_size(size), settings.S3_PART_SIZE]
+    # Powers of two and the defaults of common S3 tools
+    candidates += [mib * 2 ** i for i in range(13)]
+    candidates += [mib * size for size in (5, 10, 15, 25, 50, 100)]
+    candidates.append(-(-size // parts // mib) * mib or mib)
+    part_sizes = []
+    for candidate in candidates:
+        if candidate and -(-size // candidate) == parts and candidate not in part_sizes:
+            part_sizes.append(candidate)
+    return part_sizes
+
+
+def hash_parts(chunks, part_sizes):
+    # One StreamHasher per part size, fed from a single read
+    hashers = [StreamHasher(part_size) for part_size in part_sizes]
+    for chunk in chunks:
+        for hasher in hashers:
+            hasher.update(chunk)
+    return hashers
+
+
+def iter_file(source_path, chunk_size=8388608):
+    with open(source_path, "rb") as fp:
+        yield from iter(lambda: fp.read(chunk_size), b"")
+
+
+def calculate_multipart_etags(source_path, part_sizes):
+    return [hasher.etag for hasher in hash_parts(iter_file(source_path), part_sizes)]
+
 
 def calculate_multipart_etag(source_path, chunk_size=8388608):
     # Chuck size is 8 * 1024 * 1024 by default
@@ -19,7 +95,12 @@ def calculate_multipart_etag(source_path, chunk_size=8388608):
             if not data:
                 break
             md5s.append(hashlib.md5(data))
-    if len(md5s) > 1:
+    return get_multipart_etag(md5s)
+
+
+def get_multipart_etag(md5s, multipart=False):
+    # multipart: a 1 part multipart upload still gets a "-1" ETag
+    if len(md5s) > 1 or multipart and md5s:
         digests = b"".join(m.digest() for m in md5s)
         new_md5 = hashlib.md5(digests)
         new_etag = '"%s-%s"' % (new_md5.hexdigest(), len(md5s))
@@ -30,47 +111,275 @@ def calculate_multipart_etag(source_path, chunk_size=8388608):
     return new_etag
 
 
-def check_crc(filename, entry_id):
-    url = get_epg_log_url(entry_id)
-    with epg_retrieve(url) as r:
+class StreamHasher(object):
+    # CRC32 and S3 multipart ETag of a stream read once, part_size has to
+    # match the part size the object was uploaded with
+    def __init__(self, part_size=8388608):
+        self.part_size = part_size
+        self.crc32 = 0
+        self.size = 0
+        self.md5s = []
+        self._left = 0
+
+    def update(self, data):
+        self.crc32 = zlib.crc32(data, self.crc32)
+        self.size += len(data)
+        view = memoryview(data)
+        while view:
+            if not self._left:
+                self.md5s.append(hashlib.md5())
+                self._left = self.part_size
+            chunk = view[:self._left]
+            self.md5s[-1].update(chunk)
+            self._left -= len(chunk)
+            view = view[len(chunk):]
+
+    @property
+    def etag(self):
+        return get_multipart_etag(self.md5s)
+
+
+def encode_crc32(crc32):
+    # S3 additional checksums are the base64 of the big-endian value
+    return base64.b64encode(crc32.to_bytes(4, "big")).decode()
+
+
+def crc_in_log(crc32, content):
+    return hex(crc32)[2:] in content
+
+
+def calculate_crc32(source_path, chunk_size=8388608):
+    crc32 = 0
+    with open(source_path, "rb") as fp:
+        while True:
+            data = fp.read(chunk_size)
+            if not data:
+                break
+            crc32 = zlib.crc32(data, crc32)
+    return crc32
+
+
+def get_quick_digest(source_path, sample_size=1048576):
+    # Size plus the first & last MiB; enough to tell recordings apart
+    # without reading the whole file
+    size = os.path.getsize(source_path)
+    digest = hashlib.blake2b(str(size).encode(), digest_size=16)
+    with open(source_path, "rb") as fp:
+        digest.update(fp.read(sample_size))
+        if size > sample_size:
+            fp.seek(max(sample_size, size - sample_size))
+            digest.update(fp.read(sample_size))
+    return digest.hexdigest()
+
+
+class HeadReader(object):
+    # Read-only view of the first max_bytes of a file
+    mode = "rb"
+
+    def __init__(self, fp, max_bytes):
+        self.fp = fp
+        self.size = min(max_bytes, os.fstat(fp.fileno()).st_size)
+        self.pos = 0
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        if whence == os.SEEK_CUR:
+            offset += self.pos
+        elif whence == os.SEEK_END:
+            offset += self.size
+        self.pos = max(0, min(offset, self.size))
+        self.fp.seek(self.pos)
+        return self.pos
+
+    def tell(self):
+        return self.pos
+
+    def read(self, size=-1):
+        remaining = self.size - self.pos
+        if size is None or size < 0 or size > remaining:
+            size = remaining
+        data = self.fp.read(size)
+        self.pos += len(data)
+        return data
+
+
+def parse_mediainfo(filename, parse_speed=0.5, max_bytes=0):
+    # Runs in a worker process, so only take & return picklable values
+    if not max_bytes:
+        return MediaInfo.parse(filename, parse_speed=parse_speed).to_json()
+    with open(filename, "rb") as fp:
+        return MediaInfo.parse(HeadReader(fp, max_bytes), parse_speed=parse_speed).to_json()
+
+
+def get_mediainfo_key(digest):
+    return f"mediainfo_{digest}"
+
+
+def run_in(pool, func, *args):
+    # Run func in the given executor (if any) and wait for the result
+    if pool is None:
+        return func(*args)
+    return pool.submit(func, *args).result()
+
+
+def get_epg_log(entry_id, source=None):
+    url = get_epg_log_url(entry_id, source)
+    with epg_retrieve(url, source=source) as r:
         r.raise_for_status()
-        content = r.text
+        return r.text
+
+
+def check_crc(filename, entry_id, hash_pool=None, source=None):
+    content = get_epg_log(entry_id, source)
+    save_epg_log(filename, content)
+    crc32 = run_in(hash_pool, calculate_crc32, filename)
+    return crc_in_log(crc32, content)
+
+
+def save_epg_log(filename, content):
     with open(f"{filename}.log", "w") as fp:
         fp.write(content)
-    with open(filename, "rb") as fp:
-        crc32 = zlib.crc32(fp.read())
-    return hex(crc32)[2:] in content
 
 
-def check_etag(filename, url):
+def get_remote_etag(url):
     with requests.head(url) as r:
-        uploaded = r.headers["ETag"]
-    log.info(f"Uploaded etag {uploaded} for {filename}")
-    log.info(f"python calculate_multipart_etag.py '{filename}' 8 {uploaded}")
-    local = calculate_multipart_etag(filename)
-    return local in uploaded
-
-
-def download_file(url, filename):
-    # got from https://stackoverflow.com/a/16696317
+        return r.headers["ETag"], int(r.headers["Content-Length"])
+
+
+def check_etag(filename, url, hash_pool=None, part_size=None):
+    uploaded, size = get_remote_etag(url)
+    # The part size used for the upload isn't always known, derive it from
+    # the ETag and hash the file once for every size that could match
+    part_sizes = get_etag_part_sizes(uploaded, size, part_size)
+    log.info(f"Uploaded etag {uploaded} for {filename}, part sizes {part_sizes}")
+    if not part_sizes or os.path.getsize(filename) != size:
+        return False
+    return uploaded in run_in(hash_pool, calculate_multipart_etags, filename, part_sizes)
+
+
+class RateLimiter(object):
+    # Token bucket shared between threads, rate is in bytes per second
+    def __init__(self, rate):
+        self.rate = rate
+        self.allowance = rate
+        self.last_check = time.monotonic()
+        self.lock = Lock()
+
+    def consume(self, amount):
+        if not self.rate:
+            return
+        with self.lock:
+            now = time.monotonic()
+            self.allowance = min(self.rate, self.allowance + (now - self.last_check) * self.rate)
+            self.last_check = now
+            self.allowance -= amount
+            wait = -self.allowance / self.rate if self.allowance < 0 else 0
+            # Sleep while holding the lock so waiting threads are served in turn
+            if wait:
+                time.sleep(wait)
+
+
+bandwidth = RateLimiter(settings.BANDWIDTH_LIMIT)
+
+
+def iter_throttled(chunks):
+    for chunk in chunks:
+        bandwidth.consume(len(chunk))
+        yield chunk
+
+
+def download_file(url, filename, source=None, size=None):
+    # Preallocate the file so big recordings aren't fragmented, and read the
+    # socket straight into a large reusable buffer
     log.info(f"Downloading {filename}")
-    with epg_retrieve(url, stream=True) as r:
+    buf = bytearray(settings.DOWNLOAD_BUFFER_SIZE)
+    view = memoryview(buf)
+    with epg_retrieve(url, stream=True, source=source) as r:
         r.raise_for_status()
-        with open(filename, "wb") as f:
-            for chunk in r.iter_content(chunk_size=8192):
-                if chunk:  # filter out keep-alive new chunks
-                    f.write(chunk)
+        with open(filename, "wb", buffering=0) as f:
+            fd = f.fileno()
+            if size:
+                preallocate(fd, int(size))
+            advise(fd, 0, 0, "POSIX_FADV_SEQUENTIAL")
+            written = 0
+            while True:
+                n = read_full(r.raw, view)
+                if not n:
+                    break
+                bandwidth.consume(n)
+                write_full(f, view[:n])
+                if settings.DOWNLOAD_FSYNC == "always":
+                    os.fsync(fd)
+                    # Don't let the recording push everything else out of the
+                    # page cache, only clean pages can be dropped
+                    advise(fd, written, n, "POSIX_FADV_DONTNEED")
+                written += n
+            # The preallocated size may be larger than what was received
+            f.truncate(written)
+            if settings.DOWNLOAD_FSYNC in ("always", "end"):
+                os.fsync(fd)
+                advise(fd, 0, 0, "POSIX_FADV_DONTNEED")
     return filename
 
 
+def iter_epg_range(url, offset=0, source=None):
+    # What was added to a growing file since offset
+    headers = {"Range": f"bytes={offset}-"}
+    with epg_retrieve(url, stream=True, source=source, headers=headers) as r:
+        if r.status_code == 416:
+            return
+        r.raise_for_status()
+        if offset and r.status_code != 206:
+            raise ValueError(f"{url} does not support Range requests")
+        for chunk in r.iter_content(settings.DOWNLOAD_BUFFER_SIZE):
+            bandwidth.consume(len(chunk))
+            yield chunk
+
+
+def get_epg_info(entry_id, source=None):
+    with epg_retrieve(get_epg_info_url(entry_id, source), source=source) as r:
+        r.raise_for_status()
+        return r.json()
+
+
+def read_full(raw, view):
+    # Fill the buffer, a single read returns as soon as any data arrives
+    total = 0
+    while total < len(view):
+        n = raw.readinto(view[total:])
+        if not n:
+            break
+        total += n
+    return total
+
+
+def write_full(f, view):
+    # An unbuffered write may write less than it was given
+    while view:
+        n = f.write(view)
+        view = view[n:]
+
+
+def preallocate(fd, size):
+    if not hasattr(os, "posix_fallocate"):
+        return
+    try:
+        os.posix_fallocate(fd, 0, size)
+    except OSError:
+        log.warning("Could not preallocate file", exc_info=True)
+
+
+def advise(fd, offset, length, advice):
+    if settings.DOWNLOAD_FADVISE and hasattr(os, "posix_fadvise"):
+        os.posix_fadvise(fd, offset, length, getattr(os, advice))
+
+
 def get_datetime():
     return datetime.now().isoformat()
 
 
-def epg_request(url, method="GET", **kwargs):
-    kwargs["auth"] = requests.auth.HTTPBasicAuth(
-        settings.EPG_USER, settings.EPG_PASSWORD
-    )
+def epg_request(url, method="GET", source=None, **kwargs):
+    source = source or get_source()
+    kwargs["auth"] = requests.auth.HTTPBasicAuth(source.user, source.password)
     return requests.request(method, url, **kwargs)
 
 
@@ -78,55 +387,56 @@ def epg_retrieve(url, **kwargs):
     return epg_request(url, **kwargs)
 
 
-def get_epg_list_url():
-    return "{}://{}/api/recorded/".format(settings.EPG_PROTOCOL, settings.EPG_HOST,)
+def get_epg_list_url(source=None):
+    source = source or get_source()
+    return "{}/api/recorded/".format(source.base_url)
 
 
-def get_epg_file_url(entry_id):
-    return "{}://{}/api/recorded/{}/file".format(
-        settings.EPG_PROTOCOL, settings.EPG_HOST, entry_id,
-    )
+def get_epg_file_url(entry_id, source=None):
+    source = source or get_source()
+    return "{}/api/recorded/{}/file".format(source.base_url, entry_id)
 
 
-def get_epg_free():
-    url = "{}://{}/api/storage".format(settings.EPG_PROTOCOL, settings.EPG_HOST,)
-    with epg_retrieve(url) as r:
+def get_epg_free(source=None):
+    source = source or get_source()
+    url = "{}/api/storage".format(source.base_url)
+    with epg_retrieve(url, source=source) as r:
         r.raise_for_status()
         data = r.json()
     return data
 
 
-def get_epg_log_url(entry_id):
-    return "{}://{}/api/recorded/{}/log".format(
-        settings.EPG_PROTOCOL, settings.EPG_HOST, entry_id,
-    )
+def get_epg_log_url(entry_id, source=None):
+    source = source or get_source()
+    return "{}/api/recorded/{}/log".format(source.base_url, entry_id)
 
 
-def get_epg_index_url(entry_id):
-    return "{}://{}/api/recorded/{}/file".format(
-        settings.EPG_PROTOCOL, settings.EPG_HOST, entry_id,
-    )
+def get_epg_index_url(entry_id, source=None):
+    source = source or get_source()
+    return "{}/api/recorded/{}/file".format(source.base_url, entry_id)
 
 
-def get_epg_info_url(entry_id):
-    return "{}://{}/api/recorded/{}/".format(
-        settings.EPG_PROTOCOL, settings.EPG_HOST, entry_id,
-    )
+def get_epg_info_url(entry_id, source=None):
+    source = source or get_source()
+    return "{}/api/recorded/{}/".format(source.base_url, entry_id)
 
 
-def get_epg_entries(data):
-    for entry in data["recorded"]:
-        entry_id = entry["id"]
+def get_epg_entries(data, source=None):
+    source = source or get_source()
+    for payload in data["recorded"]:
+        entry_id = payload["id"]
         try:
-            filename = unquote_plus(entry["filename"])
+            filename = unquote_plus(payload["filename"])
         except KeyError:
-            log.warning(f"Skipping {entry['id']} has no filename: {entry}")
+            log.warning(f"Skipping {payload['id']} has no filename: {payload}")
             continue
-        if not entry["recording"]:
-            entry["db_key"] = get_db_key(entry_id)
+        if not payload["recording"] or settings.TAIL_RECORDINGS:
+            entry = Entry.from_epg(payload)
+            entry["source"] = source.name
+            entry["db_key"] = get_db_key(entry_id, source)
             entry["filename"] = filename
-            entry["epg_file_url"] = get_epg_file_url(entry_id)
-            entry["epg_index_url"] = get_epg_index_url(entry_id)
+            entry["epg_file_url"] = get_epg_file_url(entry_id, source)
+            entry["epg_index_url"] = get_epg_index_url(entry_id, source)
             yield entry
         else:
             log.warn(f"Skipping {filename}")
@@ -136,27 +446,181 @@ def get_s3_origin_url(entry):
     return f"{settings.AWS_S3_ENDPOINT_URL}/{settings.AWS_STORAGE_BUCKET_NAME}/{quote(entry['s3_key'])}"
 
 
+def get_s3_keys(entry):
+    # Video and every sidecar that upload_to_s3 creates
+    s3_key = entry["s3_key"]
+    return [s3_key] + [f"{s3_key}{suffix}" for suffix in SIDECAR_SUFFIXES]
+
+
 def get_cdn_url(entry):
     return f"{settings.CDN_ENDPOINT_URL}/{quote(entry['s3_key'])}"
 
 
-def get_db_key(entry_id):
-    return f"{settings.KEY_PREFIX}_{entry_id}"
+def get_db_key(entry_id, source=None):
+    source = source or get_source()
+    return f"{source.key_prefix}_{entry_id}"
+
+
+def is_db_key(key):
+    return key.startswith(tuple(f"{source.key_prefix}_" for source in sources))
 
 
 def get_db_entries(sort=False):
+    # Let queued writes land first, unless we'd be blocking the writer
+    if not database.in_transaction():
+        kv_store.flush()
     if not sort:
-        for entry in kv_store[kv_store.key.startswith(settings.KEY_PREFIX)]:
-            yield entry
+        for source in sources:
+            for entry in kv_store[kv_store.key.startswith(f"{source.key_prefix}_")]:
+                yield load_entry(entry)
     else:
-        for key in sorted(list(kv_store.keys())):
-            if key.startswith(settings.KEY_PREFIX):
-                yield kv_store[key]
+        # Sort in SQL and stream the rows instead of loading every key first
+        query = kv_store.query(kv_store.value).where(is_entry_key()).order_by(kv_store.key)
+        for (entry,) in query.iterator():
+            yield load_entry(entry)
+
+
+def iter_entries_with_raw():
+    # Entries and their raw payloads in key order from two cursors, instead of
+    # looking up the raw key of every entry
+    kv_store.flush()
+    entries = kv_store.query(kv_store.key, kv_store.value).where(is_entry_key()).order_by(kv_store.key)
+    raws = iter(
+        kv_store.query(kv_store.key, kv_store.value)
+        .where(kv_store.key.startswith("raw_"))
+        .order_by(kv_store.key)
+        .iterator()
+    )
+    raw_key, raw = next(raws, (None, None))
+    for key, value in entries.iterator():
+        entry = load_entry(value)
+        while raw_key is not None and raw_key[4:] < key:
+            raw_key, raw = next(raws, (None, None))
+        if raw_key is not None and raw_key[4:] == key:
+            entry._raw = raw
+        yield entry
+
+
+@contextmanager
+def open_ndjson(path, mode="r", compression=None):
+    # Text stream of path, "-" for stdin/stdout. compression is gzip, zstd or
+    # none, by default it's picked from the extension.
+    if compression is None:
+        compression = {".gz": "gzip", ".zst": "zstd"}.get(os.path.splitext(path)[1], "none")
+    stdio = sys.stdin.buffer if mode == "r" else sys.stdout.buffer
+    fileobj = stdio if path == "-" else open(path, mode + "b")
+    try:
+        if compression == "gzip":
+            stream = gzip.GzipFile(fileobj=fileobj, mode=mode)
+        elif compression == "zstd":
+            try:
+                import zstandard
+            except ImportError:
+                raise RuntimeError("zstd needs the zstandard package (pip install epg_downloader[zstd])")
+            if mode == "r":
+                stream = zstandard.ZstdDecompressor().stream_reader(fileobj, closefd=False)
+            else:
+                stream = zstandard.ZstdCompressor().stream_writer(fileobj, closefd=False)
+        else:
+            stream = fileobj
+        text = io.TextIOWrapper(stream, encoding="utf-8")
+        try:
+            yield text
+        finally:
+            if stream is stdio:
+                # Leave stdin/stdout open
+                text.flush()
+                text.detach()
+            else:
+                text.close()
+    finally:
+        if fileobj is not stdio:
+            fileobj.close()
+
+
+def is_entry_key():
+    return reduce(
+        operator.or_, (kv_store.key.startswith(f"{source.key_prefix}_") for source in sources),
+    )
 
 
 def check_in_local_key(key):
-    return key in kv_store.keys()
+    return key in kv_store
+
+
+def get_db_entries_by_status(status="all"):
+    for entry in get_db_entries(sort=True):
+        if status != "all" and entry.get("epg_status") != status and entry.get("s3_status") != status:
+            continue
+        yield entry
 
 
 def get_db_entry(entry_id):
-    return kv_store[get_db_key(entry_id)]
+    return load_entry(kv_store[get_db_key(entry_id)])
+
+
+def get_display_width(text):
+    # Japanese titles take 2 columns per character
+    return sum(2 if unicodedata.east_asian_width(char) in "WF" else 1 for char in text)
+
+
+def is_number(value):
+    try:
+        float(value)
+    except (TypeError, ValueError):
+        return False
+    return True
+
+
+def format_table(rows, sample_size=100):
+    # Same look as tabulate's default format, but the widths come from the
+    # first sample_size rows so the rest can be printed as they are read
+    rows = iter(rows)
+    sample = [row for _, row in zip(range(sample_size), rows)]
+    if not sample:
+        return
+    headers = list(sample[0])
+    # tabulate pads headers by 2
+    widths = {
+        header: max([get_display_width(header) + 2] + [get_display_width(str(row[header])) for row in sample])
+        for header in headers
+    }
+    numeric = {header: all(is_number(row[header]) for row in sample) for header in headers}
+
+    def format_row(values):
+        cells = []
+        for header, value in zip(headers, values):
+            padding = " " * max(0, widths[header] - get_display_width(str(value)))
+            cells.append(f"{padding}{value}" if numeric[header] else f"{value}{padding}")
+        return "  ".join(cells).rstrip()
+
+    yield format_row(headers)
+    yield "  ".join("-" * widths[header] for header in headers)
+    for row in sample:
+        yield format_row(row.values())
+    for row in rows:
+        yield format_row(row.values())
+
+
+def format_rows(rows, fmt="table"):
+    if fmt == "table":
+        yield from format_table(rows)
+    elif fmt == "ndjson":
+        for row in rows:
+            yield json.dumps(row, ensure_ascii=False)
+    elif fmt in ("csv", "tsv"):
+        buf = io.StringIO()
+        writer = None
+        for row in rows:
+            if writer is None:
+                writer = csv.DictWriter(
+                    buf, fieldnames=list(row), delimiter="\t" if fmt == "tsv" else ",",
+                    lineterminator="\n",
+                )
+                writer.writeheader()
+            writer.writerow(row)
+            yield buf.getvalue().rstrip("\n")
+            buf.seek(0)
+            buf.truncate()
+    else:
+        raise ValueError(f"Unknown format {fmt}")
@@ -13,11 +13,11 @@ with open('HISTORY.rst') as history_file:
 
 requirements = [
     'Click>=6.0',
-    'boto3>=1.9',
+    'boto3>=1.36',  # ChecksumType for S3_CHECKSUM
     'environs>=4.2',
     'logzero>=1.5.0',
     'peewee>=3.9',
-    'pymediainfo>=4.2.1',
+    'pymediainfo>=5.0',
     'requests>=2.22',
     'tabulate>=0.8.3',
 ]
@@ -48,6 +48,7 @@ setup(
             'epg_downloader=epg_downloader.cli:main',
         ],
     },
+    extras_require={'async': ['aiohttp>=3.8'], 'zstd': ['zstandard']},
     install_requires=requirements,
     license="GNU General Public License v3",
     long_description=readme + '\n\n' + history,
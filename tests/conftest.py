@@ -0,0 +1,25 @@
+import os
+import tempfile
+
+import pytest
+
+# Never open the database of a real install, DATABASE_PATH is read when
+# epg_downloader.app is imported
+os.environ["DATABASE_PATH"] = os.path.join(tempfile.mkdtemp(), "epg_downloader.db")
+
+
+@pytest.fixture
+def db(tmp_path, monkeypatch):
+    """Empty database in tmp_path."""
+    from epg_downloader import models
+    from epg_downloader.app import database, kv_store, settings
+
+    path = str(tmp_path / "epg_downloader.db")
+    kv_store.flush()
+    database.init(path, timeout=settings.SQLITE_BUSY_TIMEOUT)
+    monkeypatch.setattr(settings, "DATABASE_PATH", path)
+    kv_store.model.create_table()
+    models.create_tables()
+    yield database
+    kv_store.flush()
+    database.close()
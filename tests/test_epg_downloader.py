@@ -3,12 +3,16 @@
 
 """Tests for `epg_downloader` package."""
 
+import hashlib
+import zlib
+
 import pytest
 
 from click.testing import CliRunner
 
 from epg_downloader import epg_downloader
 from epg_downloader import cli
+from epg_downloader import utils
 
 
 @pytest.fixture
@@ -36,3 +40,406 @@ def test_command_line_interface():
     help_result = runner.invoke(cli.main, ['--help'])
     assert help_result.exit_code == 0
     assert '--help  Show this message and exit.' in help_result.output
+
+
+def test_calculate_crc32(tmp_path):
+    path = tmp_path / "video.ts"
+    data = b"0123456789" * 1000
+    path.write_bytes(data)
+    assert utils.calculate_crc32(path, chunk_size=333) == zlib.crc32(data)
+
+
+def test_etag_part_size_is_derived_from_part_count(tmp_path):
+    source = tmp_path / "video.ts"
+    source.write_bytes(b"x" * (50 * 1024 * 1024 + 3))
+    size = source.stat().st_size
+    etag = utils.calculate_multipart_etag(source, 15 * 1024 * 1024)
+    part_sizes = utils.get_etag_part_sizes(etag, size)
+    assert 15 * 1024 * 1024 in part_sizes
+    assert etag in utils.calculate_multipart_etags(source, part_sizes)
+    assert utils.get_part_size(40 * 1024 ** 3) >= 64 * 1024 * 1024
+
+
+def test_first_source_keeps_the_default_key_prefix(monkeypatch):
+    from epg_downloader.app import load_sources, settings
+
+    monkeypatch.setattr(settings, "EPG_SOURCES", [
+        {"name": "tuner1", "host": "a"}, {"name": "tuner2", "host": "b"},
+    ])
+    assert [source.key_prefix for source in load_sources()] == [settings.KEY_PREFIX, "tuner2"]
+
+
+def test_check_selects_only_entries_each_check_applies_to(db):
+    from epg_downloader.app import kv_store
+    from epg_downloader.models import Entry
+
+    kv_store["epgd_1"] = Entry(id=1, db_key="epgd_1", epg_status="downloaded", s3_key="a.ts")
+    kv_store["epgd_2"] = Entry(id=2, db_key="epgd_2", epg_status="deleted", s3_key="b.ts")
+    kv_store["epgd_3"] = Entry(id=3, db_key="epgd_3", epg_status="downloaded")
+    kv_store.flush()
+    selected = {
+        kind: [entry["id"] for entry in epg_downloader.get_entries_to_check(kind=kind)] for kind in ("dl", "ul")
+    }
+    assert selected == {"dl": [1, 3], "ul": [1, 2]}
+
+
+def test_job_backoff_is_exponential_and_capped():
+    from epg_downloader.app import settings
+    from epg_downloader.models import get_backoff
+
+    assert get_backoff(2) == 2 * get_backoff(1)
+    assert get_backoff(100).total_seconds() == settings.JOB_BACKOFF_MAX_SECONDS
+
+
+def test_job_claim_is_exclusive_until_lease_expires(db):
+    from datetime import datetime, timedelta
+    from epg_downloader.models import Job
+
+    Job.enqueue("test_1", reset=True)
+    job = Job.claim("worker-a", "test")
+    assert job.db_key == "test_1"
+    assert Job.claim("worker-b", "test") is None
+    Job.update(lease_expires_on=datetime.now() - timedelta(seconds=1)).where(
+        Job.id == job.id
+    ).execute()
+    assert Job.claim("worker-b", "test").worker_id == "worker-b"
+    assert not job.advance()
+
+
+def test_job_fails_when_its_entry_is_not_saved(db, monkeypatch):
+    from types import SimpleNamespace
+    from epg_downloader.app import kv_store
+    from epg_downloader.models import Entry, Job
+
+    kv_store["test_1"] = Entry(id=1, db_key="test_1", s3_status="uploaded")
+    Job.enqueue("test_1", stage="cleanup", reset=True)
+    kv_store.flush()
+
+    def fail(rows):
+        raise ValueError("disk full")
+
+    def retain_local(entry):
+        entry["local_status"] = "retained"
+        kv_store[entry["db_key"]] = entry
+
+    monkeypatch.setattr(kv_store, "write_hooks", kv_store.write_hooks + [fail])
+    monkeypatch.setattr(epg_downloader, "retain_local", retain_local)
+    monkeypatch.setattr(epg_downloader, "delete_from_epg", lambda **kwargs: None)
+    assert epg_downloader.run_source_jobs(SimpleNamespace(key_prefix="test"), "worker-a") == 0
+    job = Job.get(Job.db_key == "test_1")
+    assert (job.stage, job.attempts, job.last_error) == ("cleanup", 1, "ValueError('disk full')")
+
+
+def test_entry_keeps_epg_payload_apart():
+    import pickle
+    from epg_downloader.models import MISSING, Entry
+
+    entry = Entry.from_epg({"id": 1, "name": "News", "description": "Long text"})
+    entry["db_key"] = "test_1"
+    entry["sidecar_status"] = {"log": "uploaded"}
+    assert entry.pop_unsaved_raw()["description"] == "Long text"
+    restored = pickle.loads(pickle.dumps(entry))
+    assert restored["name"] == "News"
+    assert restored["sidecar_status"] == {"log": "uploaded"}
+    assert "s3_key" not in restored
+    assert restored.get("s3_status", "-") == "-"
+    # Payload fields are only read through raw, lookups don't load it
+    assert "description" not in restored
+    assert restored._raw is MISSING
+
+
+def test_evict_local_removes_least_recently_used(db, tmp_path, monkeypatch):
+    from epg_downloader.app import kv_store, settings
+    from epg_downloader.models import Entry, LocalFile
+
+    monkeypatch.setattr(settings, "LOCAL_CACHE_SIZE", 10)
+    for i in (1, 2, 3):
+        filename = tmp_path / f"{i}.ts"
+        filename.write_bytes(b"x" * 4)
+        entry = Entry.from_dict({"id": i, "db_key": f"test_{i}", "filename": str(filename)})
+        kv_store[entry["db_key"]] = entry
+        epg_downloader.retain_local(entry)
+        LocalFile.touch("test_1")
+    assert not (tmp_path / "2.ts").exists()
+    LocalFile.touch("test_1")
+    assert epg_downloader.evict_local(4) == 4
+    assert (tmp_path / "1.ts").exists()
+    assert not (tmp_path / "3.ts").exists()
+    assert kv_store["test_3"]["local_status"] == "deleted"
+
+
+def test_kv_store_merges_field_updates_from_threads(db):
+    from concurrent.futures import ThreadPoolExecutor
+    from epg_downloader.app import kv_store
+    from epg_downloader.models import Entry, load_entry
+
+    entry = Entry.from_epg({"id": 1, "name": "News"})
+    entry["db_key"] = "test_patch"
+    kv_store["test_patch"] = entry
+
+    def update(i):
+        entry = load_entry(kv_store["test_patch"])
+        entry[f"field_{i}"] = i
+        kv_store["test_patch"] = entry
+
+    with ThreadPoolExecutor(8) as pool:
+        list(pool.map(update, range(8)))
+    kv_store.flush()
+    entry = kv_store["test_patch"]
+    assert [entry[f"field_{i}"] for i in range(8)] == list(range(8))
+    assert entry["name"] == "News"
+
+
+def test_kv_store_whole_saves_keep_queued_fields(db):
+    from epg_downloader.app import kv_store
+    from epg_downloader.models import Entry, load_entry
+
+    kv_store["test_whole"] = Entry(id=1, db_key="test_whole", name="News")
+    kv_store.flush()
+    with kv_store._cond:
+        # Hold the writer so both saves are queued together
+        patched = load_entry(kv_store["test_whole"])
+        patched["s3_status"] = "uploaded"
+        kv_store["test_whole"] = patched
+        whole = Entry(id=1, db_key="test_whole", name="Weather")
+        kv_store["test_whole"] = whole
+    whole["name"] = "Changed after saving"
+    kv_store.flush()
+    entry = kv_store["test_whole"]
+    assert entry["name"] == "Weather"
+    assert entry["s3_status"] == "uploaded"
+
+
+def test_kv_store_flush_raises_only_own_failures(db, monkeypatch):
+    from concurrent.futures import ThreadPoolExecutor
+    from epg_downloader.app import kv_store
+
+    def fail(rows):
+        if "test_bad" in rows:
+            raise ValueError("bad row")
+
+    monkeypatch.setattr(kv_store, "write_hooks", kv_store.write_hooks + [fail])
+
+    def save_bad():
+        kv_store["test_bad"] = {"id": 1}
+
+    def flush_bad():
+        with pytest.raises(ValueError):
+            kv_store.flush()
+
+    with ThreadPoolExecutor(1) as pool:
+        pool.submit(save_bad).result()
+        # Waits for the failed write, but it wasn't this thread's
+        kv_store.flush()
+        kv_store["test_good"] = {"id": 2}
+        kv_store.flush()
+        pool.submit(flush_bad).result()
+    assert kv_store["test_good"] == {"id": 2}
+    assert "test_bad" not in kv_store
+
+
+class FakeS3Client(object):
+    def __init__(self, fail_part=None):
+        self.parts = {}
+        self.fail_part = fail_part
+
+    def create_multipart_upload(self, **kwargs):
+        return {"UploadId": "upload-1"}
+
+    def upload_part(self, PartNumber, Body, **kwargs):
+        if PartNumber == self.fail_part:
+            self.fail_part = None
+            raise ConnectionError("reset")
+        self.parts[PartNumber] = Body
+        return {"ETag": f'"{hashlib.md5(Body).hexdigest()}"'}
+
+    def get_paginator(self, name):
+        client = self
+
+        class Paginator(object):
+            def paginate(self, **kwargs):
+                parts = [
+                    {"PartNumber": n, "ETag": f'"{hashlib.md5(body).hexdigest()}"'}
+                    for n, body in client.parts.items()
+                ]
+                return [{"Parts": parts}]
+        return Paginator()
+
+    def complete_multipart_upload(self, MultipartUpload, **kwargs):
+        md5s = [hashlib.md5(self.parts[part["PartNumber"]]) for part in MultipartUpload["Parts"]]
+        return {"ETag": utils.get_multipart_etag(md5s)}
+
+    def abort_multipart_upload(self, **kwargs):
+        pass
+
+
+def test_stalled_mirror_is_dropped_without_holding_up_the_primary(tmp_path, monkeypatch):
+    from threading import Event
+    from epg_downloader.app import settings
+    from epg_downloader.clients import S3, upload_multipart_to
+
+    monkeypatch.setattr(settings, "S3_MIRROR_MAX_BEHIND", 1)
+    monkeypatch.setattr(settings, "S3_MIRROR_TIMEOUT", 0.2)
+
+    class StalledClient(FakeS3Client):
+        def upload_part(self, **kwargs):
+            stalled.wait()
+            return super().upload_part(**kwargs)
+
+    stalled = Event()
+    path = tmp_path / "video.ts"
+    path.write_bytes(bytes(range(256)) * 100)
+    primary, mirror = S3(workers=1), S3(name="backup", workers=1)
+    primary._client, mirror._client = FakeS3Client(), StalledClient()
+    try:
+        results = upload_multipart_to([primary, mirror], str(path), part_size=5000, checksum=False)
+    finally:
+        stalled.set()
+    assert results["primary"]["etag"] == results["primary"]["expected_etag"]
+    assert isinstance(results["backup"], RuntimeError)
+
+
+def test_mirror_as_fast_as_the_primary_gets_every_part(tmp_path):
+    import time
+    from epg_downloader.clients import S3, upload_multipart_to
+
+    class SlowClient(FakeS3Client):
+        def upload_part(self, **kwargs):
+            time.sleep(0.002)
+            return super().upload_part(**kwargs)
+
+    path = tmp_path / "video.ts"
+    path.write_bytes(bytes(range(250)) * 400)
+    primary, mirror = S3(workers=4), S3(name="backup", workers=4)
+    primary._client, mirror._client = SlowClient(), SlowClient()
+    results = upload_multipart_to([primary, mirror], str(path), part_size=1000, checksum=False)
+    assert results["backup"]["etag"] == results["backup"]["expected_etag"] == results["primary"]["etag"]
+
+
+def test_interrupted_multipart_upload_resumes(tmp_path):
+    from epg_downloader.clients import S3, upload_multipart_to
+
+    path = tmp_path / "video.ts"
+    path.write_bytes(bytes(range(256)) * 100)
+    s3 = S3(workers=1)
+    s3._client = FakeS3Client(fail_part=3)
+    saved = {}
+    with pytest.raises(ConnectionError):
+        upload_multipart_to([s3], str(path), part_size=5000, checksum=False, save_state=saved.update)
+    assert saved[s3.name]["upload_id"] == "upload-1"
+    assert saved[s3.name]["part_size"] == 5000
+
+    uploaded = []
+    upload_part = s3._client.upload_part
+    s3._client.upload_part = lambda **kwargs: uploaded.append(kwargs["PartNumber"]) or upload_part(**kwargs)
+    result = upload_multipart_to([s3], str(path), checksum=False, resume=saved)[s3.name]
+    assert uploaded == [3, 4, 5, 6]
+    assert result["etag"] == result["expected_etag"]
+
+
+def test_stats_are_grouped_in_sql(db):
+    from epg_downloader.app import kv_store
+    from epg_downloader.models import Entry, EntryStats
+
+    for i, status in enumerate(["uploaded", "uploaded", "upload_error"]):
+        entry = Entry.from_epg({"id": i, "channelId": 9999, "startAt": 1700000000000, "filesize": 10})
+        entry["db_key"] = f"epgd_{i}"
+        entry["epg_status"] = "downloaded"
+        entry["s3_status"] = status
+        kv_store[entry["db_key"]] = entry
+    rows = {
+        (row["channel"], row["status"]): row
+        for row in epg_downloader.get_stats(["channel", "status"])
+    }
+    assert rows[("9999", "uploaded")]["count"] == 2
+    assert rows[("9999", "uploaded")]["s3_bytes"] == 20
+    assert rows[("9999", "upload_error")]["s3_bytes"] == 0
+
+    # Saved before EntryStats existed
+    EntryStats.delete().where(EntryStats.db_key != "epgd_0").execute()
+    rows = {row["status"]: row for row in epg_downloader.get_stats(["status"])}
+    assert rows["uploaded"]["count"] == 2
+
+
+def test_old_entries_are_migrated_on_read_and_in_batches(db):
+    from epg_downloader.app import kv_store
+    from epg_downloader.models import SCHEMA_VERSION
+
+    # Saved by 0.3, before schema versions
+    for i in range(3):
+        kv_store[f"epgd_{i}"] = {"id": i, "epg_key": f"epgd_{i}", "epg_status": "uploaded"}
+    entry = epg_downloader.get_entry("epgd_0")
+    assert entry["local_status"] == "uploaded"
+    assert entry.has_changes()
+
+    progress = list(epg_downloader.migrate_data(batch_size=2))
+    assert progress == [(2, 2), (3, 3)]
+    assert kv_store["schema"]["version"] == SCHEMA_VERSION
+    entry = kv_store["epgd_1"]
+    assert entry["schema_version"] == SCHEMA_VERSION
+    assert entry["db_key"] == "epgd_1"
+    assert not entry.has_changes()
+
+
+def test_export_import_round_trip(db, tmp_path):
+    import io
+    import json
+    from epg_downloader.app import get_raw_key, kv_store
+    from epg_downloader.models import Entry
+
+    entry = Entry.from_epg({"id": 7, "name": "Drama", "description": "Episode 1"})
+    entry["db_key"] = "epgd_7"
+    entry["epg_status"] = "downloaded"
+    kv_store[entry["db_key"]] = entry
+    path = str(tmp_path / "entries.ndjson.gz")
+    with utils.open_ndjson(path, "w") as stream:
+        assert epg_downloader.export_entries(stream) == 1
+    with utils.open_ndjson(path) as stream:
+        lines = stream.readlines()
+    exported = json.loads(lines[0])
+    assert len(lines) == 1
+    assert exported["db_key"] == "epgd_7"
+    assert exported["description"] == "Episode 1"
+    assert exported["epg_status"] == "downloaded"
+    assert epg_downloader.export_entries(io.StringIO(), since="2999-01-01") == 0
+
+    del kv_store["epgd_7"]
+    del kv_store[get_raw_key("epgd_7")]
+    with utils.open_ndjson(path) as stream:
+        assert epg_downloader.import_entries(stream) == 1
+    kv_store.flush()
+    assert kv_store[get_raw_key("epgd_7")]["description"] == "Episode 1"
+    entry = epg_downloader.get_entry("epgd_7")
+    assert (entry["id"], entry["name"], entry["epg_status"]) == (7, "Drama", "downloaded")
+    assert entry["updated_on"] == exported["updated_on"]
+
+
+def test_aio_limits_requests_per_host():
+    pytest.importorskip("aiohttp")
+    import asyncio
+    from epg_downloader import aio
+
+    running = {"now": 0, "max": 0}
+
+    async def fake_request(engine, url):
+        async with engine.limit(url):
+            running["now"] += 1
+            running["max"] = max(running["max"], running["now"])
+            await asyncio.sleep(0.01)
+            running["now"] -= 1
+        return url
+
+    urls = [f"http://host{i % 2}/api/recorded/{i}/" for i in range(20)]
+    results = list(aio.iter_completed(lambda engine: [fake_request(engine, url) for url in urls], per_host=3))
+    assert sorted(results) == sorted(urls)
+    assert running["max"] == 6
+
+
+def test_format_table_matches_tabulate():
+    from tabulate import tabulate
+
+    rows = [
+        {"id": 1, "epg": "downloaded", "name": "ニュース"},
+        {"id": 10, "epg": "-", "name": "Weather"},
+    ]
+    assert "\n".join(utils.format_rows(rows)) == tabulate(rows, headers="keys")